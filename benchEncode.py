@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+#
+# Benchmark of tile encoding, time against bytes on disk, for
+# PIL's adaptive palette and a fixed palette at several zlib settings
+#
+# ./benchEncode.py MBTILES/ncds_20c.mbtiles
+# ./benchEncode.py --palette rncPalette.json MBTILES/ncds_20c.mbtiles
+#   without --palette one is built from the sampled tiles
+#
+
+import argparse
+import io
+import sqlite3
+import time
+import numpy as np
+from PIL import Image
+
+import mbtilesQuilt
+import pngEncode
+
+
+def panelTiles(fn, count):
+    # Masked RGBA tiles with data, as they reach encodeTile
+    images = []
+    with sqlite3.connect(fn) as conn:
+        for (png,) in conn.execute('SELECT tile_data FROM tiles LIMIT ?;', (count,)):
+            (image, hasData) = mbtilesQuilt.makePngColorTransparent(png)
+            if hasData:
+                images.append(image)
+    return images
+
+
+def mismatch(images, pngs):
+    # Fraction of pixels whose color, or transparency, changed in encoding
+    changed = 0
+    total = 0
+    for (image, png) in zip(images, pngs):
+        a = np.asarray(image)
+        b = np.asarray(Image.open(io.BytesIO(png)).convert('RGBA'))
+        aClear = a[:, :, 3] == 0
+        bClear = b[:, :, 3] == 0
+        changed += ((aClear != bClear) | (~aClear & (a[:, :, :3] != b[:, :, :3]).any(axis=2))).sum()
+        total += aClear.size
+    return changed / total if total else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mbtiles', help='Panel to take tiles from')
+    parser.add_argument('--palette', help='JSON palette from pngEncode.py')
+    parser.add_argument('--count', type=int, default=500, help='Number of tiles')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs')
+    args = parser.parse_args()
+
+    images = panelTiles(args.mbtiles, args.count)
+    if not images:
+        parser.error('No tiles with data in {}'.format(args.mbtiles))
+    if args.palette:
+        palette = pngEncode.loadPalette(args.palette)
+    else:
+        palette = pngEncode.buildPalette([args.mbtiles], sample=args.count)
+
+    encoders = [('adaptive level 6', pngEncode.TileEncoder())]
+    for level in (1, 6, 9):
+        encoders.append(('fixed level {}'.format(level), pngEncode.TileEncoder(palette, level)))
+    encoders.append(('fixed level 9 optimize', pngEncode.TileEncoder(palette, 9, True)))
+
+    print('{} tiles, {} palette colors'.format(len(images), len(palette)))
+    print('{:24s} {:>10s} {:>10s} {:>9s}'.format('encoding', 'us/tile', 'bytes/tile', 'changed'))
+    for (name, encoder) in encoders:
+        best = None
+        for i in range(args.repeat):
+            t0 = time.perf_counter()
+            pngs = [encoder.encode(image, '{"units": "feet"}') for image in images]
+            dt = time.perf_counter() - t0
+            best = dt if best is None else min(best, dt)
+        nBytes = sum(len(png) for png in pngs)
+        print('{:24s} {:10.1f} {:10.0f} {:8.3f}%'.format(
+            name, best / len(images) * 1e6, nBytes / len(images),
+            100 * mismatch(images, pngs)))
+
+
+if __name__ == "__main__":
+    main()
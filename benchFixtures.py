@@ -0,0 +1,187 @@
+#! /usr/bin/env python3
+#
+# Synthetic ncds_*.mbtiles panels for benchmarking without the 11GB of NOAA panels
+#
+# Each panel is a block of tiles at the deepest zoom and the blocks of its
+# parent tiles at the zooms above it. Successive panels are shifted east so
+# that neighbours share the given fraction of their columns. Tiles are empty
+# (fully transparent), chart background, or chart detail drawn in a few
+# palette colors, in the given proportions, all from a fixed seed so the
+# same arguments always give the same bytes.
+#
+# ./benchFixtures.py BENCH --panels 4 --tiles 2000 --overlap 0.5
+#   writes BENCH/ncds_b00.mbtiles ... BENCH/ncds_b03.mbtiles and BENCH/region.geojson
+#
+
+import argparse
+import io
+import json
+import math
+import os
+import os.path
+import random
+import sqlite3
+from PIL import Image, ImageDraw
+
+from globalmaptiles import GlobalMercator
+
+background = (0xF4, 0xE8, 0xC1)
+chartColors = [(0xEF, 0xD8, 0xA3), (0xB5, 0xD7, 0xE7), (0x7F, 0xB2, 0xD0), (0x00, 0x00, 0x00),
+               (0xD0, 0x30, 0x8C), (0x6C, 0x6C, 0x6C), (0x9E, 0xC8, 0x8A), (0xFF, 0xFF, 0xFF)]
+baseZoom = 13 # the first panel's corner, somewhere off the west coast, at this zoom
+baseColumn = 1100
+baseRow = 2600
+
+
+def encode(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def tilePool(rng, nDetail=64):
+    # (empty, background, [detail, ...]) png bytes, detail tiles are palette images like NOAA's
+    empty = encode(Image.new('RGBA', (256, 256), (0, 0, 0, 0)))
+    back = encode(Image.new('RGB', (256, 256), background).convert('P'))
+    details = []
+    for i in range(nDetail):
+        image = Image.new('RGB', (256, 256), background)
+        draw = ImageDraw.Draw(image)
+        for j in range(rng.randint(5, 40)):
+            (x, y) = (rng.randrange(256), rng.randrange(256))
+            color = rng.choice(chartColors)
+            if rng.random() < 0.5:
+                draw.line([x, y, x + rng.randint(-128, 128), y + rng.randint(-128, 128)],
+                          fill=color, width=rng.randint(1, 3))
+            else:
+                draw.rectangle([x, y, x + rng.randint(4, 80), y + rng.randint(4, 80)], fill=color)
+        details.append(encode(image.convert('P')))
+    return (empty, back, details)
+
+
+def panelBlock(index, nTiles, overlap, zoom=baseZoom):
+    # (column, row, width, height) of a panel at zoom, its deepest
+    # The corner is in the same place at every zoom, moved south if need be so the rows fit.
+    width = max(1, int(math.sqrt(nTiles)))
+    height = max(1, nTiles // width)
+    step = max(1, int(round(width * (1 - overlap))))
+    shift = zoom - baseZoom
+    (column, row) = ((baseColumn << shift, baseRow << shift) if shift >= 0 else
+                     (baseColumn >> -shift, baseRow >> -shift))
+    return (column + index * step, max(0, min(row, 2 ** zoom - height)), width, height)
+
+
+def makePanel(fn, block, zooms, pool, rng, emptyFraction, backgroundFraction):
+    # Write one panel, returns the number of tiles
+    (empty, back, details) = pool
+    (column, row, width, height) = block
+    maxZoom = max(zooms)
+    if os.path.exists(fn):
+        os.remove(fn)
+    count = 0
+    with sqlite3.connect(fn) as conn:
+        conn.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER,'
+                     ' tile_row INTEGER, tile_data BLOB);')
+        conn.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);')
+        conn.execute('CREATE TABLE metadata (name TEXT, value TEXT);')
+        conn.executemany('INSERT INTO metadata VALUES (?,?);',
+                         [('name', os.path.basename(fn)), ('format', 'png'),
+                          ('minzoom', str(min(zooms))), ('maxzoom', str(maxZoom))])
+        for zoom in sorted(zooms):
+            shift = maxZoom - zoom
+            rows = []
+            end = 2 ** zoom # A block too big for the zoom is cut off at its edge
+            for tx in range(column >> shift, min(end, ((column + width - 1) >> shift) + 1)):
+                for ty in range(row >> shift, min(end, ((row + height - 1) >> shift) + 1)):
+                    k = rng.random()
+                    if k < emptyFraction:
+                        png = empty
+                    elif k < emptyFraction + backgroundFraction:
+                        png = back
+                    else:
+                        png = rng.choice(details)
+                    rows.append((zoom, tx, ty, png))
+            conn.executemany('INSERT INTO tiles VALUES (?,?,?,?);', rows)
+            count += len(rows)
+    return count
+
+
+def makePanels(outdir, nPanels=4, nTiles=2000, overlap=0.5, emptyFraction=0.15,
+               backgroundFraction=0.25, zooms=range(9, 14), seed=1):
+    # Write nPanels panels of about nTiles tiles each at the deepest zoom
+    # returns the list of panel names, in quilting order
+    os.makedirs(outdir, exist_ok=True)
+    rng = random.Random(seed)
+    pool = tilePool(rng)
+    panels = []
+    for index in range(nPanels):
+        panel = 'b{:02d}'.format(index)
+        makePanel(os.path.join(outdir, 'ncds_{}.mbtiles'.format(panel)),
+                  panelBlock(index, nTiles, overlap, max(zooms)), zooms, pool, rng,
+                  emptyFraction, backgroundFraction)
+        panels.append(panel)
+    return panels
+
+
+def makeUpdate(panelFn, updateFn, fraction=0.1, seed=2):
+    # An update file replacing fraction of a panel's tiles, and the deletes
+    # JSON NOAA would publish for another fraction of them
+    # returns the deletes JSON text
+    rng = random.Random(seed)
+    pool = tilePool(rng, 16)
+    if os.path.exists(updateFn):
+        os.remove(updateFn)
+    with sqlite3.connect(panelFn) as src:
+        keys = src.execute('SELECT zoom_level,tile_column,tile_row FROM tiles;').fetchall()
+    rng.shuffle(keys)
+    nChanged = int(len(keys) * fraction)
+    with sqlite3.connect(updateFn) as conn:
+        conn.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER,'
+                     ' tile_row INTEGER, tile_data BLOB);')
+        conn.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);')
+        conn.executemany('INSERT INTO tiles VALUES (?,?,?,?);',
+                         [key + (rng.choice(pool[2]),) for key in keys[:nChanged]])
+    deleted = [{'z': z, 'x': x, 'y': y} for (z, x, y) in keys[nChanged:2 * nChanged]]
+    return json.dumps({'deleted_tiles': deleted})
+
+
+def makeRegion(fn, nPanels=4, nTiles=2000, overlap=0.5, zoom=13, nVertices=24):
+    # A GeoJSON polygon, roughly an ellipse, over the middle of the panels
+    mercator = GlobalMercator()
+    (c0, r0, width, height) = panelBlock(0, nTiles, overlap, zoom)
+    (c1, r1, w1, h1) = panelBlock(nPanels - 1, nTiles, overlap, zoom)
+    (south, west, n, e) = mercator.TileLatLonBounds(c0, r0, zoom)
+    (s, w, north, east) = mercator.TileLatLonBounds(c1 + w1 - 1, r1 + h1 - 1, zoom)
+    (lat, lon) = ((south + north) / 2, (west + east) / 2)
+    (dLat, dLon) = ((north - south) * 0.4, (east - west) * 0.4)
+    ring = [[lon + dLon * math.cos(2 * math.pi * i / nVertices),
+             lat + dLat * math.sin(2 * math.pi * i / nVertices)] for i in range(nVertices)]
+    ring.append(ring[0])
+    with open(fn, 'w') as fp:
+        json.dump({'type': 'Feature', 'properties': {},
+                   'geometry': {'type': 'Polygon', 'coordinates': [ring]}}, fp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic panels for benchmarking')
+    parser.add_argument('outdir', help='where to write the panels')
+    parser.add_argument('--panels', type=int, default=4, help='Number of panels')
+    parser.add_argument('--tiles', type=int, default=2000, help='Tiles per panel at the deepest zoom')
+    parser.add_argument('--overlap', type=float, default=0.5,
+                        help='Fraction of its columns a panel shares with the next')
+    parser.add_argument('--empty', type=float, default=0.15, help='Fraction of empty tiles')
+    parser.add_argument('--background', type=float, default=0.25, help='Fraction of background tiles')
+    parser.add_argument('--minZoom', type=int, default=9, help='Shallowest zoom')
+    parser.add_argument('--maxZoom', type=int, default=13, help='Deepest zoom')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+
+    panels = makePanels(args.outdir, args.panels, args.tiles, args.overlap, args.empty,
+                        args.background, range(args.minZoom, args.maxZoom + 1), args.seed)
+    makeRegion(os.path.join(args.outdir, 'region.geojson'), args.panels, args.tiles,
+               args.overlap, args.maxZoom)
+    print('Wrote panels', ' '.join(panels), 'to', args.outdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#! /usr/bin/env python3
+#
+# Timed scenarios on synthetic panels, runs offline
+#
+#   quilt     quilt every panel into an empty tree
+#   merge     quilt heavily overlapping panels into a tree already holding the first one
+#   update    apply an update file and a deletes list to a panel, as mbtilesFetch.py --update does
+#   coverage  enumerate the tiles inside a polygon with tileIsInPolygon.py
+#
+# Quilts run mbtilesQuilt.py as a separate process with --stats, so its
+# report is kept with the timing. Every timed quilt starts without a uniform
+# tile cache or coverage index, so the repeats all measure the same. Each
+# scenario's best of --repeat runs is appended as a JSON line to --results,
+# with the git version and the machine, so results can be compared across
+# versions.
+#
+# ./benchSuite.py
+# ./benchSuite.py --tiles 20000 --workers 4 --scenarios quilt merge
+#
+
+import argparse
+import datetime
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import benchFixtures
+
+scenarios = ['quilt', 'merge', 'update', 'coverage']
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def gitVersion():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=here,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def freshCaches(workdir):
+    # An empty directory for a quilt's uniform tile cache and coverage index
+    cachedir = os.path.join(workdir, 'caches')
+    shutil.rmtree(cachedir, ignore_errors=True)
+    os.makedirs(cachedir)
+    return cachedir
+
+
+def quilt(indir, outdir, panels, workers, statsFn, cachedir):
+    # Run mbtilesQuilt.py, returns (seconds, stats report)
+    command = [sys.executable, os.path.join(here, 'mbtilesQuilt.py'),
+               '--indir', indir, '--outdir', outdir, '--workers', str(workers),
+               '--uniformCache', os.path.join(cachedir, 'uniformTiles.db'),
+               '--coverage', os.path.join(cachedir, 'coverage.db'),
+               '--stats', statsFn, '--statsInterval', '0'] + panels
+    t0 = time.perf_counter()
+    subprocess.check_call(command, stdout=subprocess.DEVNULL)
+    dt = time.perf_counter() - t0
+    with open(statsFn, 'r') as fp:
+        report = json.load(fp)
+    report.pop('workerReports', None)
+    return (dt, report)
+
+
+def benchQuilt(args, workdir, panels):
+    outdir = os.path.join(workdir, 'quilt')
+    shutil.rmtree(outdir, ignore_errors=True)
+    (dt, report) = quilt(os.path.join(workdir, 'panels'), outdir, panels, args.workers,
+                         os.path.join(workdir, 'quilt.json'), freshCaches(workdir))
+    return (dt, report['counters'].get('tiles', 0), report)
+
+
+def benchMerge(args, workdir, panels):
+    indir = os.path.join(workdir, 'overlapping')
+    outdir = os.path.join(workdir, 'merge')
+    shutil.rmtree(outdir, ignore_errors=True)
+    statsFn = os.path.join(workdir, 'merge.json')
+    quilt(indir, outdir, panels[:1], args.workers, statsFn,
+          freshCaches(workdir)) # untimed, the tree to merge into
+    (dt, report) = quilt(indir, outdir, panels[1:], args.workers, statsFn, freshCaches(workdir))
+    return (dt, report['counters'].get('tiles', 0), report)
+
+
+def benchUpdate(args, workdir, panels):
+    import mbtilesFetch
+    src = os.path.join(workdir, 'panels', 'ncds_{}.mbtiles'.format(panels[0]))
+    ofn = os.path.join(workdir, 'update.mbtiles')
+    sfn = os.path.join(workdir, 'update.update.mbtiles')
+    shutil.copyfile(src, ofn)
+    deletes = benchFixtures.makeUpdate(ofn, sfn, args.updateFraction)
+    t0 = time.perf_counter()
+    deleted = mbtilesFetch.procDeletes(ofn, deletes, False)
+    replaced = mbtilesFetch.applyUpdate(sfn, ofn, False)
+    dt = time.perf_counter() - t0
+    return (dt, len(deleted) + len(replaced), {'deleted': len(deleted), 'replaced': len(replaced)})
+
+
+def benchCoverage(args, workdir, panels):
+    import tileIsInPolygon # needs shapely, only for this scenario
+    poly = tileIsInPolygon.loadPolygon(os.path.join(workdir, 'panels', 'region.geojson'))
+    zooms = range(0, args.maxZoom + 4)
+    t0 = time.perf_counter()
+    nTiles = sum(tileIsInPolygon.spanCount(tileIsInPolygon.coveredSpans(poly, zoom))
+                 for zoom in zooms)
+    dt = time.perf_counter() - t0
+    return (dt, nTiles, {'zooms': [min(zooms), max(zooms)]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the quilter on synthetic panels')
+    parser.add_argument('--scenarios', nargs='+', choices=scenarios, default=scenarios,
+                        help='Scenarios to run')
+    parser.add_argument('--results', default='benchResults.jsonl',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--workdir', help='where to put the panels and output, default a temporary directory')
+    parser.add_argument('--keep', action='store_true', help='Keep the work directory')
+    parser.add_argument('--panels', type=int, default=4, help='Number of panels')
+    parser.add_argument('--tiles', type=int, default=2000, help='Tiles per panel at the deepest zoom')
+    parser.add_argument('--overlap', type=float, default=0.25,
+                        help='Fraction of columns neighbouring panels share, for quilt')
+    parser.add_argument('--mergeOverlap', type=float, default=0.9,
+                        help='Fraction of columns neighbouring panels share, for merge')
+    parser.add_argument('--empty', type=float, default=0.15, help='Fraction of empty tiles')
+    parser.add_argument('--background', type=float, default=0.25, help='Fraction of background tiles')
+    parser.add_argument('--maxZoom', type=int, default=13, help='Deepest zoom of the panels')
+    parser.add_argument('--updateFraction', type=float, default=0.1,
+                        help='Fraction of a panel replaced, and deleted, by the update')
+    parser.add_argument('--workers', type=int, default=1, help='mbtilesQuilt.py --workers')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchSuite.')
+    os.makedirs(workdir, exist_ok=True)
+    zooms = range(args.maxZoom - 4, args.maxZoom + 1)
+    panels = benchFixtures.makePanels(os.path.join(workdir, 'panels'), args.panels, args.tiles,
+                                      args.overlap, args.empty, args.background, zooms)
+    benchFixtures.makeRegion(os.path.join(workdir, 'panels', 'region.geojson'), args.panels,
+                             args.tiles, args.overlap, args.maxZoom)
+    if 'merge' in args.scenarios:
+        benchFixtures.makePanels(os.path.join(workdir, 'overlapping'), args.panels, args.tiles,
+                                 args.mergeOverlap, args.empty, args.background, zooms)
+
+    common = {'version': gitVersion(),
+              'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'system': platform.system(),
+              'cpus': os.cpu_count(),
+              'params': {'panels': args.panels, 'tiles': args.tiles, 'overlap': args.overlap,
+                         'mergeOverlap': args.mergeOverlap, 'empty': args.empty,
+                         'background': args.background, 'maxZoom': args.maxZoom,
+                         'updateFraction': args.updateFraction, 'workers': args.workers}}
+    benches = {'quilt': benchQuilt, 'merge': benchMerge,
+               'update': benchUpdate, 'coverage': benchCoverage}
+    try:
+        with open(args.results, 'a') as fp:
+            for scenario in args.scenarios:
+                best = None
+                for i in range(args.repeat):
+                    (dt, nTiles, detail) = benches[scenario](args, workdir, panels)
+                    if best is None or dt < best[0]:
+                        best = (dt, nTiles, detail)
+                (dt, nTiles, detail) = best
+                result = dict(common, scenario=scenario, seconds=dt, tiles=nTiles,
+                              tilesPerSecond=nTiles / dt if dt else None, detail=detail)
+                fp.write(json.dumps(result) + '\n')
+                fp.flush()
+                print('{:10s} {:8.3f}s {:8d} tiles {:10.1f} tiles/s'.format(
+                    scenario, dt, nTiles, result['tilesPerSecond'] or 0))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print('Results appended to', args.results)
+
+
+if __name__ == "__main__":
+    main()
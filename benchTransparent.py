@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+#
+# Micro-benchmark of makeImageColorTransparent against the original
+# per-color masking it replaced
+#
+# ./benchTransparent.py                          synthetic tiles
+# ./benchTransparent.py MBTILES/ncds_20c.mbtiles  tiles from a panel
+#
+
+import argparse
+import io
+import sqlite3
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+
+import mbtilesQuilt
+
+
+def originalColorTransparent(image):
+    # The per-color mask version of makeImageColorTransparent, kept as the reference
+    array = np.array(image, dtype=np.ubyte)
+    mask = array[:, :, -1] == 0 # original alpha
+    for color in mbtilesQuilt.colors:
+        mask |= (array[:,:,:3] == color).all(axis=2)
+    alpha = np.where(mask, 0, 255)
+    array[:,:,-1] = alpha
+    hasData = alpha.max() > 0
+    imageOut = Image.fromarray(np.ubyte(array))
+    return (imageOut, hasData)
+
+
+def syntheticTiles(count):
+    # Tiles with background fill, chart colors and transparent areas
+    rng = np.random.RandomState(0)
+    images = []
+    for i in range(count):
+        image = Image.new('RGBA', (256, 256), tuple(mbtilesQuilt.colors[i % 2]) + (255,))
+        draw = ImageDraw.Draw(image)
+        for j in range(8):
+            (x, y) = rng.randint(0, 200, 2)
+            fill = tuple(int(v) for v in rng.randint(0, 256, 3)) + (255,)
+            draw.rectangle([x, y, x + 60, y + 60], fill=fill)
+        draw.rectangle([0, 0, 63, 255], fill=(0, 0, 0, 0))
+        images.append(image)
+    return images
+
+
+def panelTiles(fn, count):
+    images = []
+    with sqlite3.connect(fn) as conn:
+        for (png,) in conn.execute('SELECT tile_data FROM tiles LIMIT ?;', (count,)):
+            images.append(Image.open(io.BytesIO(png)).convert('RGBA'))
+    return images
+
+
+def timeIt(func, images, repeat):
+    best = None
+    for i in range(repeat):
+        copies = [image.copy() for image in images] # both versions get fresh input
+        t0 = time.perf_counter()
+        for image in copies:
+            func(image)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mbtiles', nargs='?', help='Panel to take tiles from, synthetic if not given')
+    parser.add_argument('--count', type=int, default=500, help='Number of tiles')
+    parser.add_argument('--repeat', type=int, default=5, help='Best of this many runs')
+    args = parser.parse_args()
+
+    images = panelTiles(args.mbtiles, args.count) if args.mbtiles else syntheticTiles(args.count)
+
+    for image in images: # Check the results agree before timing them
+        (a, aData) = originalColorTransparent(image.copy())
+        (b, bData) = mbtilesQuilt.makeImageColorTransparent(image.copy())
+        if bool(aData) != bData or (aData and a.tobytes() != b.tobytes()):
+            raise Exception('makeImageColorTransparent differs from the original')
+
+    tOriginal = timeIt(originalColorTransparent, images, args.repeat)
+    tCurrent = timeIt(mbtilesQuilt.makeImageColorTransparent, images, args.repeat)
+    print('{} tiles, {} colors'.format(len(images), len(mbtilesQuilt.colors)))
+    print('original {:8.1f} us/tile'.format(tOriginal * 1e6))
+    print('current  {:8.1f} us/tile'.format(tCurrent * 1e6))
+    print('speedup  {:8.1f}x'.format(tOriginal / tCurrent))
+
+
+if __name__ == "__main__":
+    main()
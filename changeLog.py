@@ -0,0 +1,51 @@
+#! /usr/bin/env python3
+#
+# Log of the tiles changed by mbtilesFetch.py --update
+#
+# mbtilesFetch.py records the (zoom, column, row) of every tile it replaces
+# or deletes, per panel, and mbtilesQuilt.py --incremental recomposites just
+# those tiles and then clears the log.
+#
+
+import sqlite3
+
+
+def openChangeLog(fn):
+    conn = sqlite3.connect(fn, timeout=60, check_same_thread=False) # quiltPipeline.py reads it in a thread
+    conn.execute('CREATE TABLE IF NOT EXISTS changes'
+                 ' (panel TEXT, zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,'
+                 ' PRIMARY KEY (panel, zoom_level, tile_column, tile_row)) WITHOUT ROWID;')
+    conn.execute('CREATE INDEX IF NOT EXISTS changes_tile'
+                 ' ON changes (zoom_level, tile_column, tile_row);')
+    return conn
+
+
+def recordChanges(conn, panel, keys):
+    # keys is an iterable of (zoom, column, row) in TMS rows
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO changes VALUES (?,?,?,?);',
+                         ((panel, zoom, column, row) for (zoom, column, row) in keys))
+
+
+def changedTiles(conn, nWorkers=1, worker=0):
+    # Distinct changed tiles over all panels, sorted, for one shard of the rows
+    return conn.execute('SELECT DISTINCT zoom_level,tile_column,tile_row FROM changes'
+                        ' WHERE tile_row % ? = ?'
+                        ' ORDER BY zoom_level,tile_column,tile_row;',
+                        (nWorkers, worker))
+
+
+def countChanges(conn):
+    return conn.execute('SELECT COUNT(DISTINCT panel), COUNT(*) FROM changes;').fetchone()
+
+
+def clearChanges(conn):
+    with conn:
+        conn.execute('DELETE FROM changes;')
+
+
+def clearTiles(conn, keys):
+    # Forget the changes to the (zoom, column, row) in keys, from every panel
+    with conn:
+        conn.executemany('DELETE FROM changes WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
+                         keys)
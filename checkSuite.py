@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+#
+# Regression checks on synthetic panels and downloads, runs offline
+#
+#   panelOrder  quilting through the coverage index keeps the panels in quilting
+#               order, not name order
+#   metadata    with --metadataUnits oldFormatMBTiles the last panel's grid_id
+#               wins, even where its tile is fully transparent
+#   downloader  downloader.py against a local HTTP stand-in for NOAA's server:
+#               fetching, skipping unchanged panels, resuming an interrupted
+#               transfer with a Range request and starting over from a stale one
+#
+# Each check writes its panels with benchFixtures.py, or its downloads, into the
+# work directory, and prints ok or FAILED with what went wrong. The exit status
+# is the number of checks that failed.
+#
+# ./checkSuite.py
+# ./checkSuite.py --checks panelOrder --workdir CHECK
+#
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import os.path
+import random
+import re
+import shutil
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from PIL import Image
+
+import benchFixtures
+import changeLog
+import coverageIndex
+import mbtilesQuilt
+import panels
+
+
+def quilt(order, **options):
+    # mbtilesQuilt.quilt without its progress dots
+    with open(os.devnull, 'w') as fp, contextlib.redirect_stdout(fp):
+        return mbtilesQuilt.quilt(order, verbose=False, quiet=True, **options)
+
+
+def treeTiles(outdir):
+    # {path relative to outdir: png bytes} of a quilted tree
+    tiles = {}
+    for (dirpath, dirnames, filenames) in os.walk(outdir):
+        for filename in filenames:
+            fn = os.path.join(dirpath, filename)
+            with open(fn, 'rb') as fp:
+                tiles[os.path.relpath(fn, outdir)] = fp.read()
+    return tiles
+
+
+def differing(expected, actual):
+    # Paths missing from, added to or changed in actual
+    return sorted(path for path in set(expected) | set(actual)
+                  if expected.get(path) != actual.get(path))
+
+
+def checkPanelOrder(workdir):
+    # An incremental quilt of every tile through the coverage index against a plain quilt,
+    # with the panels quilted in the reverse of their name order
+    indir = os.path.join(workdir, 'panelOrder')
+    order = benchFixtures.makePanels(indir, 2, 400, 0.5, zooms=range(11, 14))[::-1]
+    index = coverageIndex.CoverageIndex(os.path.join(indir, 'coverage.db'))
+    conn = changeLog.openChangeLog(os.path.join(indir, 'changes.db'))
+    for panel in order:
+        fn = panels.panelFilename(indir, panel)
+        index.update(fn)
+        with sqlite3.connect(fn) as src:
+            changeLog.recordChanges(conn, panel,
+                                    src.execute('SELECT zoom_level,tile_column,tile_row FROM tiles;'))
+    index.close()
+    conn.close()
+
+    plain = os.path.join(workdir, 'panelOrderPlain')
+    quilt(order, indir=indir, outdir=plain, coverage=os.path.join(workdir, 'noCoverage.db'))
+    indexed = os.path.join(workdir, 'panelOrderIndexed')
+    quilt(order, indir=indir, outdir=indexed, incremental=True)
+    expected = treeTiles(plain)
+    paths = differing(expected, treeTiles(indexed))
+    if paths:
+        return '{} of {} tiles differ, e.g. {}'.format(len(paths), len(expected), paths[0])
+    return None
+
+
+def transparentTile():
+    # A fully transparent tile with a one color palette, so the classifier knows it without decoding
+    image = Image.new('P', (256, 256), 0)
+    image.putpalette([0, 0, 0])
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', transparency=0)
+    return buffer.getvalue()
+
+
+def checkMetadata(workdir):
+    # Two panels with map tables, the top one fully transparent, against the grid_id
+    # of the last panel with a tile, as merging one panel at a time kept
+    indir = os.path.join(workdir, 'metadata')
+    order = benchFixtures.makePanels(indir, 2, 400, 0.5, zooms=range(11, 14))
+    expected = {}
+    for panel in order:
+        with sqlite3.connect(panels.panelFilename(indir, panel)) as conn:
+            if panel == order[-1]:
+                conn.execute('UPDATE tiles SET tile_data=?;', (transparentTile(),))
+            conn.execute('CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER,'
+                         ' tile_row INTEGER, tile_id TEXT, grid_id TEXT);')
+            conn.execute("INSERT INTO map SELECT zoom_level, tile_column, tile_row, NULL,"
+                         " '{}/' || zoom_level || '/' || tile_column || '/' || tile_row"
+                         " FROM tiles;".format(panel))
+            for (zoom, column, row, gridId) in conn.execute(
+                    'SELECT zoom_level, tile_column, tile_row, grid_id FROM map;'):
+                expected[(zoom, column, (2 ** zoom) - (1 + row))] = gridId
+
+    outdir = os.path.join(workdir, 'metadataQuilt')
+    quilt(order, indir=indir, outdir=outdir, metadataUnits='oldFormatMBTiles')
+    tiles = treeTiles(outdir)
+    if not tiles:
+        return 'nothing was quilted'
+    wrong = []
+    for (path, png) in sorted(tiles.items()):
+        (zoom, row, column) = path[:-len('.png')].split(os.sep)
+        key = (int(zoom[1:]), int(column), int(row))
+        if Image.open(io.BytesIO(png)).text.get('meta') != expected[key]:
+            wrong.append(path)
+    if wrong:
+        return '{} tiles have the wrong grid_id, e.g. {}'.format(len(wrong), wrong[0])
+    return None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Serves the server's files with ETag validators and Range requests, as NOAA's server does
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        (body, etag) = server.files[self.path]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        offset = 0
+        match = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range') == etag:
+            offset = int(match.group(1))
+            if offset >= len(body):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(offset, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - offset))
+        self.end_headers()
+        cut = server.cuts.pop(self.path, None) # Drop the connection part way, once
+        self.wfile.write(body[offset:cut])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.files = {} # path -> (body, etag)
+        self.cuts = {} # path -> bytes sent before the connection is dropped
+        self.requests = [] # headers of every request
+
+    def put(self, path, body):
+        self.files[path] = (body, '"{}"'.format(hashlib.sha1(body).hexdigest()))
+
+
+def checkDownloader(workdir):
+    # Downloads of two panels through the stand-in, run by downloadAll as mbtilesFetch.py does
+    import downloader # needs requests, only for this check
+    server = StandInServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/ncds_{{}}.mbtiles'.format(server.server_address[1])
+    rng = random.Random(3)
+    bodies = {}
+    def change(panel): # Bodies span several download chunks, so a cut leaves some behind
+        nBytes = 3 * downloader.chunkSize + 1000
+        bodies[panel] = rng.getrandbits(8 * nBytes).to_bytes(nBytes, 'little')
+        server.put('/ncds_{}.mbtiles'.format(panel), bodies[panel])
+    def run(expected):
+        # Download both panels, returns what went wrong or None
+        session = downloader.makeSession(2)
+        jobs = [(url.format(panel), panels.panelFilename(workdir, panel)) for panel in sorted(bodies)]
+        results = {os.path.basename(ofn)[5:-8]: status
+                   for (u, ofn, status, nBytes) in downloader.downloadAll(session, jobs, 2)}
+        session.close()
+        for panel in sorted(bodies):
+            status = results[panel]
+            if isinstance(status, Exception):
+                status = 'error'
+            if status != expected[panel]:
+                return '{} was {}, expected {}'.format(panel, status, expected[panel])
+            if status == 'error':
+                continue
+            with open(panels.panelFilename(workdir, panel), 'rb') as fp:
+                if fp.read() != bodies[panel]:
+                    return '{} does not hold the served bytes after {}'.format(panel, status)
+        return None
+
+    try:
+        # (step, panels changed on the server, bytes sent before dropping the connection,
+        #  expected statuses, number of Range requests)
+        cut = 2 * downloader.chunkSize + 500
+        steps = [('fetch', 'ab', {}, {'a': 'fetched', 'b': 'fetched'}, 0),
+                 ('unchanged', '', {}, {'a': 'unchanged', 'b': 'unchanged'}, 0),
+                 ('changed', 'a', {}, {'a': 'fetched', 'b': 'unchanged'}, 0),
+                 ('interrupted', 'b', {'b': cut}, {'a': 'unchanged', 'b': 'error'}, 0),
+                 ('resume', '', {}, {'a': 'unchanged', 'b': 'resumed'}, 1),
+                 ('interrupted again', 'b', {'b': cut}, {'a': 'unchanged', 'b': 'error'}, 0),
+                 ('stale part', 'b', {}, {'a': 'unchanged', 'b': 'fetched'}, 1)]
+        for (name, changed, cuts, expected, nRanges) in steps:
+            for panel in changed:
+                change(panel)
+            for (panel, nBytes) in cuts.items():
+                server.cuts['/ncds_{}.mbtiles'.format(panel)] = nBytes
+            del server.requests[:]
+            problem = run(expected)
+            if problem is not None:
+                return '{}: {}'.format(name, problem)
+            ranges = [headers for headers in server.requests if 'Range' in headers]
+            if len(ranges) != nRanges:
+                return '{}: {} Range requests, expected {}'.format(name, len(ranges), nRanges)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return None
+
+
+checks = {'panelOrder': checkPanelOrder, 'metadata': checkMetadata, 'downloader': checkDownloader}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the quilter on synthetic panels')
+    parser.add_argument('--checks', nargs='+', choices=sorted(checks), default=sorted(checks),
+                        help='Checks to run')
+    parser.add_argument('--workdir', help='where to put the panels and output, default a temporary directory')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='checkSuite.')
+    nFailed = 0
+    try:
+        for name in args.checks:
+            checkdir = os.path.join(workdir, name)
+            shutil.rmtree(checkdir, ignore_errors=True)
+            os.makedirs(checkdir)
+            problem = checks[name](checkdir)
+            if problem is None:
+                print('{:12s} ok'.format(name))
+            else:
+                print('{:12s} FAILED {}'.format(name, problem))
+                nFailed += 1
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(nFailed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+#
+# Which panels have a tile at (zoom, column, row), without opening the panels
+#
+# Each panel's tiles are stored as spans, one (zoom, column, rowStart, rowEnd)
+# per run of consecutive rows in a column, TMS rows, rowEnd exclusive, in an
+# SQLite file, by default MBTILES/coverage.db. A panel's spans are rebuilt
+# from its tiles index when mbtilesFetch.py fetches or updates it, and the
+# panel's size and modification time are kept so a stale entry is noticed.
+#
+# ./coverageIndex.py --indir MBTILES --build     index every panel
+# ./coverageIndex.py --indir MBTILES --refresh   reindex panels changed since
+# ./coverageIndex.py --indir MBTILES 12 654 2512 panels with TMS tile z/x/y
+#
+
+import argparse
+import bisect
+import collections
+import os
+import os.path
+import sqlite3
+
+import panels
+
+
+def panelName(fn):
+    # MBTILES/ncds_20c.mbtiles -> 20c
+    name = os.path.basename(fn)
+    if name.startswith('ncds_') and name.endswith('.mbtiles'):
+        return name[5:-8]
+    return None
+
+
+def panelStamp(fn):
+    # (size, mtime) that tells if a panel changed since it was indexed
+    st = os.stat(fn)
+    return (st.st_size, st.st_mtime)
+
+
+def panelSpans(fn):
+    # Spans of the tiles in a panel, from the tiles index, as an (n, 4) array
+    import numpy as np # only needed to index, not to look up
+    with sqlite3.connect('file:{}?mode=ro'.format(fn), uri=True) as conn:
+        keys = np.array(conn.execute('SELECT zoom_level,tile_column,tile_row FROM tiles'
+                                     ' ORDER BY zoom_level,tile_column,tile_row;').fetchall(),
+                        dtype=np.int64).reshape(-1, 3)
+    if not len(keys):
+        return np.zeros((0, 4), dtype=np.int64)
+    # A span starts wherever the zoom or column changes or a row is skipped
+    start = np.ones(len(keys), dtype=bool)
+    start[1:] = ((keys[1:, 0] != keys[:-1, 0]) | (keys[1:, 1] != keys[:-1, 1]) |
+                 (keys[1:, 2] != keys[:-1, 2] + 1))
+    first = np.flatnonzero(start)
+    last = np.append(first[1:], len(keys)) - 1
+    return np.column_stack((keys[first, 0], keys[first, 1], keys[first, 2], keys[last, 2] + 1))
+
+
+class CoverageIndex(object):
+    # Panel coverage of every tile, loaded into memory on the first lookup
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.conn = sqlite3.connect(fn, timeout=600, check_same_thread=False) # quiltPipeline.py looks up in a thread
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS panels'
+                              ' (panel TEXT PRIMARY KEY, size INTEGER, mtime REAL,'
+                              ' tiles INTEGER, spans INTEGER);')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS spans'
+                              ' (panel TEXT, zoom INTEGER, tile_column INTEGER,'
+                              ' rowStart INTEGER, rowEnd INTEGER);')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS spans_panel ON spans (panel, zoom, tile_column);')
+        self.columns = None # (zoom, column) -> sorted [(rowStart, rowEnd, panel)]
+
+    def update(self, fn, panel=None):
+        # (Re)index one panel, returns the number of spans
+        panel = panel or panelName(fn)
+        stamp = panelStamp(fn)
+        spans = panelSpans(fn)
+        nTiles = int((spans[:, 3] - spans[:, 2]).sum())
+        with self.conn:
+            self.conn.execute('DELETE FROM spans WHERE panel=?;', (panel,))
+            self.conn.executemany('INSERT INTO spans VALUES (?,?,?,?,?);',
+                                  [(panel,) + tuple(span) for span in spans.tolist()])
+            self.conn.execute('INSERT OR REPLACE INTO panels VALUES (?,?,?,?,?);',
+                              (panel,) + stamp + (nTiles, len(spans)))
+        self.columns = None
+        return len(spans)
+
+    def remove(self, panel):
+        with self.conn:
+            self.conn.execute('DELETE FROM spans WHERE panel=?;', (panel,))
+            self.conn.execute('DELETE FROM panels WHERE panel=?;', (panel,))
+        self.columns = None
+
+    def isFresh(self, fn, panel=None):
+        # True if the panel is indexed and has not changed since
+        result = self.conn.execute('SELECT size, mtime FROM panels WHERE panel=?;',
+                                   (panel or panelName(fn),)).fetchone()
+        return result is not None and tuple(result) == panelStamp(fn)
+
+    def refresh(self, fns, qVerbose=False):
+        # Reindex the panels that changed, returns the ones reindexed
+        updated = []
+        for fn in fns:
+            if not self.isFresh(fn):
+                nSpans = self.update(fn)
+                updated.append(panelName(fn))
+                if qVerbose:
+                    print('Indexed', fn, nSpans, 'spans')
+        return updated
+
+    def indexed(self):
+        # {panel: (tiles, spans)}
+        return {panel: (nTiles, nSpans) for (panel, nTiles, nSpans)
+                in self.conn.execute('SELECT panel, tiles, spans FROM panels;')}
+
+    def load(self):
+        columns = collections.defaultdict(list)
+        for (panel, zoom, column, rowStart, rowEnd) in self.conn.execute(
+                'SELECT panel, zoom, tile_column, rowStart, rowEnd FROM spans;'):
+            columns[(zoom, column)].append((rowStart, rowEnd, panel))
+        for spans in columns.values():
+            spans.sort()
+        self.columns = dict(columns)
+
+    def covering(self, zoom, column, row):
+        # Sorted names of the panels with a tile at TMS (zoom, column, row)
+        if self.columns is None:
+            self.load()
+        spans = self.columns.get((zoom, column))
+        if not spans:
+            return []
+        # Spans of different panels overlap, so check every span starting at or before row
+        end = bisect.bisect_right(spans, (row, float('inf'), ''))
+        return sorted(panel for (rowStart, rowEnd, panel) in spans[:end] if row < rowEnd)
+
+    def zooms(self, panel):
+        # Zoom levels panel has tiles at
+        return [zoom for (zoom,) in self.conn.execute(
+                'SELECT DISTINCT zoom FROM spans WHERE panel=? ORDER BY zoom;', (panel,))]
+
+    def intersects(self, panel, zoom, bounds):
+        # True if panel has a tile in the box bounds = (txMin, txMax, tyMin, tyMax), inclusive
+        (txMin, txMax, tyMin, tyMax) = bounds
+        return self.conn.execute('SELECT 1 FROM spans WHERE panel=? AND zoom=?'
+                                 ' AND tile_column BETWEEN ? AND ? AND rowStart<=? AND rowEnd>?'
+                                 ' LIMIT 1;',
+                                 (panel, zoom, txMin, txMax, tyMax, tyMin)).fetchone() is not None
+
+    def close(self):
+        self.conn.close()
+
+
+def openIfFresh(fn, fns):
+    # The index in fn if it exists and is up to date for every panel in fns, else None
+    if not fn or not os.path.exists(fn):
+        return None
+    index = CoverageIndex(fn)
+    if all(index.isFresh(name) for name in fns):
+        return index
+    index.close()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index, or look up, which panels cover each tile')
+    parser.add_argument('tile', nargs='*', type=int, help='zoom column row to look up')
+    parser.add_argument('--indir', default='MBTILES', help='where the ncds_*.mbtiles files are')
+    parser.add_argument('--coverage', help='Index file, default indir/coverage.db')
+    parser.add_argument('--xyz', action='store_true', help='The row is XYZ, origin top left, not TMS')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--build', action='store_true', help='Reindex every panel')
+    action.add_argument('--refresh', action='store_true', help='Reindex panels changed since indexed')
+    args = parser.parse_args()
+
+    index = CoverageIndex(args.coverage or os.path.join(args.indir, 'coverage.db'))
+    fns = [panels.panelFilename(args.indir, panel) for panel in panels.discoverPanels(args.indir)]
+    if args.build:
+        for fn in fns:
+            print('Indexed', fn, index.update(fn), 'spans')
+    elif args.refresh:
+        updated = index.refresh(fns, True)
+        print('Reindexed', len(updated), 'of', len(fns), 'panels')
+    if args.tile:
+        if len(args.tile) != 3:
+            parser.error('Give a tile as zoom column row')
+        (zoom, column, row) = args.tile
+        if args.xyz:
+            row = (2 ** zoom) - (1 + row)
+        print(' '.join(index.covering(zoom, column, row)))
+    elif not args.build and not args.refresh:
+        for (panel, (nTiles, nSpans)) in sorted(index.indexed().items()):
+            print(panel, nTiles, 'tiles', nSpans, 'spans')
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
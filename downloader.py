@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+#
+# Concurrent, resumable, streaming downloads of the NOAA MBTiles panels
+#
+# Each body is streamed in chunks to ofn.part and renamed over ofn when it is
+# complete. The response validators (ETag, Last-Modified) are kept beside the
+# file in ofn.headers, so an interrupted transfer resumes with an HTTP Range
+# request and a panel that has not changed on the server is not fetched again.
+#
+
+import json
+import os
+import os.path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+chunkSize = 1024 * 1024
+timeout = (30, 300) # connect, read seconds
+
+
+def makeSession(poolSize):
+    # One session shared by all the transfer threads, with a connection per thread
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def loadValidators(fn):
+    try:
+        with open(fn + '.headers', 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveValidators(fn, r):
+    validators = {}
+    for name in ('ETag', 'Last-Modified'):
+        if name in r.headers:
+            validators[name] = r.headers[name]
+    with open(fn + '.headers', 'w') as fp:
+        json.dump(validators, fp)
+
+
+def download(session, url, ofn, qVerbose=False):
+    # Fetch url into ofn
+    # returns (status, nBytes) where status is one of
+    #   'fetched', 'resumed', 'unchanged' (304), or the HTTP status code on failure
+    part = ofn + '.part'
+    headers = {'Accept-Encoding': 'identity'} # Byte offsets must match what is on disk
+    if os.path.exists(ofn): # Conditional GET against what we already have
+        validators = loadValidators(ofn)
+        if 'ETag' in validators:
+            headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators:
+            headers['If-Modified-Since'] = validators['Last-Modified']
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset:
+        validators = loadValidators(part)
+        ifRange = validators.get('ETag') or validators.get('Last-Modified')
+        if ifRange: # Only resume if the server still has the same file
+            headers['Range'] = 'bytes={}-'.format(offset)
+            headers['If-Range'] = ifRange
+        else:
+            offset = 0
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            return ('unchanged', 0)
+        if r.status_code == 416: # The partial file is no good, start over next time
+            for name in (part, part + '.headers'):
+                if os.path.exists(name):
+                    os.remove(name)
+            return (r.status_code, 0)
+        if r.status_code == 206 and offset:
+            mode = 'ab'
+            status = 'resumed'
+        elif r.status_code == 200:
+            mode = 'wb'
+            status = 'fetched'
+            offset = 0
+        else:
+            return (r.status_code, 0)
+        if qVerbose:
+            print('Saving', url, 'to', ofn, 'from byte', offset)
+        saveValidators(part, r)
+        with open(part, mode) as fp:
+            for chunk in r.iter_content(chunk_size=chunkSize):
+                fp.write(chunk)
+        size = os.path.getsize(part)
+        expected = r.headers.get('Content-Length')
+        if expected is not None and size != offset + int(expected):
+            raise IOError('Short read of {}, {} of {} bytes'.format(
+                url, size - offset, expected))
+
+    os.replace(part, ofn) # Readers never see a partial panel
+    os.replace(part + '.headers', ofn + '.headers')
+    return (status, size)
+
+
+def downloadAll(session, jobs, nWorkers, qVerbose=False):
+    # jobs is a list of (url, ofn)
+    # yields (url, ofn, status, nBytes) as transfers complete,
+    # status is an exception if the transfer failed, its .part is kept to resume from
+    with ThreadPoolExecutor(max_workers=nWorkers) as executor:
+        futures = {}
+        for (url, ofn) in jobs:
+            futures[executor.submit(download, session, url, ofn, qVerbose)] = (url, ofn)
+        for future in as_completed(futures):
+            (url, ofn) = futures[future]
+            try:
+                (status, nBytes) = future.result()
+            except (requests.RequestException, IOError) as e:
+                (status, nBytes) = (e, 0)
+            yield (url, ofn, status, nBytes)
@@ -65,6 +65,8 @@ Class is available under the open-source GDAL license (www.gdal.org).
 
 import math
 
+import numpy as np
+
 class GlobalMercator(object):
     """
     TMS Global Mercator Profile
@@ -275,6 +277,115 @@ class GlobalMercator(object):
             
         return quadKey
 
+    # Array versions of the conversions above
+    #
+    # Each takes NumPy arrays (or anything np.asarray accepts, scalars broadcast)
+    # and does the same arithmetic, in the same order, as the scalar method,
+    # so converting millions of tiles needs no Python loop. Tile, bounds and
+    # quadkey results are identical to the scalar methods, lat/lon <-> meters
+    # may differ in the last few bits since NumPy has its own log/exp/tan.
+
+    def LatLonToMetersArray(self, lat, lon ):
+        "Array version of LatLonToMeters"
+
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        mx = lon * self.originShift / 180.0
+        my = np.log( np.tan((90 + lat) * math.pi / 360.0 )) / (math.pi / 180.0)
+
+        my = my * self.originShift / 180.0
+        return mx, my
+
+    def MetersToLatLonArray(self, mx, my ):
+        "Array version of MetersToLatLon"
+
+        lon = (np.asarray(mx, dtype=np.float64) / self.originShift) * 180.0
+        lat = (np.asarray(my, dtype=np.float64) / self.originShift) * 180.0
+
+        lat = 180 / math.pi * (2 * np.arctan( np.exp( lat * math.pi / 180.0)) - math.pi / 2.0)
+        return lat, lon
+
+    def ResolutionArray(self, zoom ):
+        "Array version of Resolution"
+
+        return self.initialResolution / np.power(2.0, np.asarray(zoom))
+
+    def PixelsToMetersArray(self, px, py, zoom):
+        "Array version of PixelsToMeters"
+
+        res = self.ResolutionArray( zoom )
+        mx = np.asarray(px) * res - self.originShift
+        my = np.asarray(py) * res - self.originShift
+        return mx, my
+
+    def MetersToPixelsArray(self, mx, my, zoom):
+        "Array version of MetersToPixels"
+
+        res = self.ResolutionArray( zoom )
+        px = (np.asarray(mx) + self.originShift) / res
+        py = (np.asarray(my) + self.originShift) / res
+        return px, py
+
+    def PixelsToTileArray(self, px, py):
+        "Array version of PixelsToTile, returns int64 arrays"
+
+        tx = (np.ceil( np.asarray(px) / float(self.tileSize) ) - 1).astype(np.int64)
+        ty = (np.ceil( np.asarray(py) / float(self.tileSize) ) - 1).astype(np.int64)
+        return tx, ty
+
+    def MetersToTileArray(self, mx, my, zoom):
+        "Array version of MetersToTile"
+
+        px, py = self.MetersToPixelsArray( mx, my, zoom)
+        return self.PixelsToTileArray( px, py)
+
+    def TileBoundsArray(self, tx, ty, zoom):
+        "Array version of TileBounds"
+
+        tx = np.asarray(tx)
+        ty = np.asarray(ty)
+        minx, miny = self.PixelsToMetersArray( tx*self.tileSize, ty*self.tileSize, zoom )
+        maxx, maxy = self.PixelsToMetersArray( (tx+1)*self.tileSize, (ty+1)*self.tileSize, zoom )
+        return ( minx, miny, maxx, maxy )
+
+    def TileLatLonBoundsArray(self, tx, ty, zoom ):
+        "Array version of TileLatLonBounds"
+
+        bounds = self.TileBoundsArray( tx, ty, zoom)
+        minLat, minLon = self.MetersToLatLonArray(bounds[0], bounds[1])
+        maxLat, maxLon = self.MetersToLatLonArray(bounds[2], bounds[3])
+
+        return ( minLat, minLon, maxLat, maxLon )
+
+    def GoogleTileArray(self, tx, ty, zoom):
+        "Array version of GoogleTile, the flip is its own inverse so it also converts Google/XYZ to TMS"
+
+        zoom = np.asarray(zoom, dtype=np.int64)
+        return np.asarray(tx), ((np.int64(1) << zoom) - 1) - np.asarray(ty)
+
+    def QuadKeyArray(self, tx, ty, zoom ):
+        "QuadTree keys as int64, the value of the QuadTree string read in base 4"
+
+        tx, ty = self.GoogleTileArray( tx, ty, zoom )
+        tx, ty, zoom = np.broadcast_arrays( tx.astype(np.int64), ty.astype(np.int64),
+                                            np.asarray(zoom, dtype=np.int64) )
+        quadKey = np.zeros(tx.shape, dtype=np.int64)
+        for i in range(int(zoom.max()) if zoom.size else 0, 0, -1):
+            # Only tiles at zoom i or deeper have a digit for bit i-1
+            active = zoom >= i
+            digit = ((tx >> (i-1)) & 1) + 2 * ((ty >> (i-1)) & 1)
+            quadKey = np.where(active, quadKey * 4 + digit, quadKey)
+        return quadKey
+
+    def QuadTreeArray(self, tx, ty, zoom ):
+        "Array version of QuadTree, returns an array of strings"
+
+        quadKey = self.QuadKeyArray( tx, ty, zoom )
+        quadKey, zoom = np.broadcast_arrays( quadKey, np.asarray(zoom) )
+        return np.array([np.base_repr(int(k), 4).zfill(int(z)) if z else ""
+                         for (k, z) in zip(quadKey.ravel(), zoom.ravel())],
+                        dtype=str).reshape(quadKey.shape)
+
 #---------------------
 
 class GlobalGeodetic(object):
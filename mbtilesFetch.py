@@ -4,162 +4,239 @@
 #
 # Feb-2019, Pat Welch, pat@mousebrains.com
 #
+# From Python: mbtilesFetch.fetch(['01a'], outdir='MBTILES') or mbtilesFetch.update()
+# requests is only imported once there is something to fetch.
+#
 import argparse
 import json
 import os
 import os.path
 import sqlite3
-from tempfile import NamedTemporaryFile
 
-import requests
+import changeLog
+import coverageIndex
+import panels
+
+
+# Applied to a panel while an update is written into it
+# A rollback journal rather than WAL, so the quilter can read panels
+# from a read-only directory without a -shm file.
+updatePragmas = [
+    'PRAGMA journal_mode=DELETE;',
+    'PRAGMA synchronous=NORMAL;',
+    'PRAGMA cache_size=-262144;', # KiB, so 256MB
+    'PRAGMA temp_store=MEMORY;',
+]
+
 
+def openForUpdate(ofn):
+    # Connection to a panel in autocommit mode, so transactions are explicit
+    conn = sqlite3.connect(ofn, isolation_level=None)
+    for pragma in updatePragmas:
+        conn.execute(pragma)
+    return conn
 
-def applyUpdate(content, ofn, qVerbose):
-    with NamedTemporaryFile() as sfp:
-        sfp.write(content)
-        sfn = sfp.name
-        with sqlite3.connect(sfn) as uconn, \
-                sqlite3.connect(ofn) as oconn:
-            # Get all the tile updates
-            results = uconn.execute('SELECT * FROM tiles;').fetchall()
-            for result in results:
-                (zoom, column, row, png) = result
-                if qVerbose:
-                    print('Replacing ({},{},{},{}) in {}'.format(
-                        zoom, column, row, len(png), ofn))
-                oconn.execute('INSERT OR REPLACE INTO tiles (zoom_level,tile_column,tile_row,tile_data) VALUES(?,?,?,?);',
-                              (zoom, column, row, png))
-            oconn.commit()
+
+def applyUpdate(sfn, ofn, qVerbose):
+    # Attach the update database sfn and copy all its tiles in one statement and one transaction
+    # returns the (zoom, column, row) of the replaced tiles
+    conn = openForUpdate(ofn)
+    try:
+        conn.execute('ATTACH DATABASE ? AS updates;', (sfn,))
+        conn.execute('BEGIN;')
+        keys = conn.execute('SELECT zoom_level,tile_column,tile_row FROM updates.tiles;').fetchall()
+        conn.execute('INSERT OR REPLACE INTO main.tiles (zoom_level,tile_column,tile_row,tile_data)'
+                     ' SELECT zoom_level,tile_column,tile_row,tile_data FROM updates.tiles;')
+        conn.execute('COMMIT;')
+        conn.execute('DETACH DATABASE updates;')
+    finally:
+        conn.close() # Rolls back anything not committed
+    if qVerbose:
+        print('Replaced', len(keys), 'tiles in', ofn)
+    return keys
 
 
 def procDeletes(ofn, content, qVerbose):
-    with sqlite3.connect(ofn) as conn:
-        a = json.loads(content)
-        for item in a['deleted_tiles']:
-            zoom = item['z']
-            column = item['x']
-            row = item['y']
-            if qVerbose:
-                print('Deleting zoom={}, column={}, and row={} from {}'.format(
-                    zoom, column, row, ofn))
-            conn.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
-                         (zoom, column, row))
-
-
-parser = argparse.ArgumentParser()
-verbose = parser.add_mutually_exclusive_group()
-verbose.add_argument('--verbose', action='store_true', default=True,
-                     help='Output diagnositcs')
-verbose.add_argument('--quiet', action='store_true', default=False,
-                     help='No non-error output')
-action = parser.add_mutually_exclusive_group()
-action.add_argument('--full', action='store_true', help='Pull a full set')
-action.add_argument('--update', action='store_true',
-                    help='Pull recent updates')
-parser.add_argument('--urlfull', help='NOAA URL for full pulls',
-                    default='https://distribution.charts.noaa.gov/ncds/mbtiles/ncds_{}.mbtiles')
-# parser.add_argument('--urlupdate', help='NOAA URL for update pulls',
-#                     default='https://tileservice.charts.noaa.gov/mbtiles/50000_1/MBTILES_{}-updates.mbtiles')
-# parser.add_argument('--urldelete', help='NOAA URL for delete pulls',
-#                     default='https://tileservice.charts.noaa.gov/mbtiles/50000_1/MBTILES_{}-deletes.json')
-parser.add_argument('--panels', nargs='+', help='which panels to pull')
-parser.add_argument('--outdir', default='MBTILES',
-                    help='where to write output to')
-args = parser.parse_args()
-
-if args.panels is None:
-    args.panels = [
-                "01a",
-                "01b",
-                "01c", # 2024.06.01
-                "02a",
-                "02b",
-                "03",
-                "04",
-                "05",
-                "06",
-                "07",
-                "08",
-                "09",
-                "10",
-                "11",
-                "12",
-                "13",
-                "14",
-                "15",
-                "16",
-                "17a",
-                "17b",
-                "18",
-                "19a", # renamed from "19" 2024.06.01
-                "19b",
-                "19c",
-                "19d",
-                "20a",
-                "20b",
-                "20c",
-                "21",
-                "22a",
-                "22b",
-                "23a",
-                "23b",
-                "24a",
-                "24b",
-                "25a",
-                "25b",
-                "26a",
-                "26b",
-                "27",
-                "28a",
-                "28b",
-                "29",
-                "30",
-                "31a",
-                "31b"]
-    
-
-    # for i in range(1, 27):
-    #     args.panels.append('{:02d}'.format(i))
-
-if not args.full and not args.update:
-    args.full = True
-
-if args.full:
-    urlPattern = args.urlfull
-else:
-    urlPattern = args.urlupdate
-
-if not os.path.isdir(args.outdir):
-    os.makedirs(args.outdir)
-
-if not args.full:  # Pull down any deletes
-    for panel in args.panels:
-        url = args.urldelete.format(panel)
-        r = requests.get(url)
-        if r.status_code != 200:
-            if r.status_code != 404:
-                print('Error fetching', url, 'status_code', r.status_code)
-            continue
-        ofn = os.path.join(args.outdir, 'ncds_{}.mbtiles'.format(panel))
-        procDeletes(ofn, r.content, args.verbose)
-
-for panel in args.panels:
-    ofn = os.path.join(args.outdir, 'ncds_{}.mbtiles'.format(panel))
-    if not args.full and not os.path.exists(ofn):
-        print(ofn, 'does not exist to apply an update to')
-        continue
-    url = urlPattern.format(panel)
-    if not args.quiet:
-        print('Fetching', url)
-    r = requests.get(url)
-    if r.status_code != 200:
-        if not args.full or r.status_code != 404:
-            print('Error fetching', url, 'status_code', r.status_code)
-        continue
-    if args.full:  # Write out the full database
-        with open(ofn, 'wb') as ofp:
-            if args.verbose:
-                print('Saving', url, 'to', ofn, 'len', len(r.content))
-            ofp.write(r.content)
+    # Delete all the listed tiles in one transaction
+    # returns the (zoom, column, row) of the deleted tiles
+    a = json.loads(content)
+    keys = [(item['z'], item['x'], item['y']) for item in a['deleted_tiles']]
+    conn = openForUpdate(ofn)
+    try:
+        conn.execute('BEGIN;')
+        conn.executemany('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
+                         keys)
+        conn.execute('COMMIT;')
+    finally:
+        conn.close() # Rolls back anything not committed
+    if qVerbose:
+        print('Deleted', len(keys), 'tiles from', ofn)
+    return keys
+
+
+def removeSpool(sfn):
+    for name in (sfn, sfn + '.headers'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def applySpool(changes, panel, sfn, ofn, qVerbose):
+    # Apply a fetched update to its panel and remove the spool
+    # returns False, keeping the spool to apply next time, if the panel was locked
+    # A spool that cannot be applied for any other reason, say a corrupt
+    # download, is removed, so the update is fetched again without validators.
+    try:
+        keys = applyUpdate(sfn, ofn, qVerbose)
+    except sqlite3.Error as e:
+        print('Error applying', sfn, 'to', ofn, e)
+        if 'locked' in str(e): # by a quilt reading the panel
+            return False
+        removeSpool(sfn)
+        return True
+    changeLog.recordChanges(changes, panel, keys)
+    removeSpool(sfn)
+    return True
+
+
+def makeParser():
+    parser = argparse.ArgumentParser()
+    verbose = parser.add_mutually_exclusive_group()
+    verbose.add_argument('--verbose', action='store_true', default=True,
+                         help='Output diagnositcs')
+    verbose.add_argument('--quiet', action='store_true', default=False,
+                         help='No non-error output')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument('--full', action='store_true', help='Pull a full set')
+    action.add_argument('--update', action='store_true',
+                        help='Pull recent updates')
+    parser.add_argument('--urlfull', help='NOAA URL for full pulls',
+                        default='https://distribution.charts.noaa.gov/ncds/mbtiles/ncds_{}.mbtiles')
+    parser.add_argument('--urlupdate', help='NOAA URL for update pulls',
+                        default='https://tileservice.charts.noaa.gov/mbtiles/50000_1/MBTILES_{}-updates.mbtiles')
+    parser.add_argument('--urldelete', help='NOAA URL for delete pulls',
+                        default='https://tileservice.charts.noaa.gov/mbtiles/50000_1/MBTILES_{}-deletes.json')
+    parser.add_argument('--panels', nargs='+', help='which panels to pull')
+    parser.add_argument('--catalog', action='store_true',
+                        help='Without --panels, pull the panels listed on NOAA\'s index page rather than the default list')
+    parser.add_argument('--outdir', default='MBTILES',
+                        help='where to write output to')
+    parser.add_argument('--jobs', type=int, default=4,
+                        help='Number of concurrent downloads')
+    parser.add_argument('--changelog',
+                        help='Where updates record changed tiles for mbtilesQuilt.py --incremental, default outdir/changes.db')
+    parser.add_argument('--coverage',
+                        help='Panel coverage index to keep up to date, default outdir/coverage.db')
+    return parser
+
+
+def run(args):
+    # Fetch, or update, args.panels, the default list if None
+    import downloader
+
+    args.panels = panels.resolvePanels(args.panels, catalog=args.catalog)
+
+    if not args.full and not args.update:
+        args.full = True
+
+    if args.full:
+        urlPattern = args.urlfull
+    else:
+        urlPattern = args.urlupdate
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    session = downloader.makeSession(max(1, args.jobs))
+
+    changes = None
+    if not args.full:
+        changes = changeLog.openChangeLog(
+                args.changelog or os.path.join(args.outdir, 'changes.db'))
+
+    if not args.full:  # Pull down any deletes
+        for panel in args.panels:
+            url = args.urldelete.format(panel)
+            r = session.get(url, timeout=downloader.timeout)
+            if r.status_code != 200:
+                if r.status_code != 404:
+                    print('Error fetching', url, 'status_code', r.status_code)
+                continue
+            ofn = panels.panelFilename(args.outdir, panel)
+            changeLog.recordChanges(changes, panel,
+                                    procDeletes(ofn, r.content, args.verbose))
+
+    if args.full:  # Stream the full databases to disk
+        jobs = []
+        for panel in args.panels:
+            jobs.append((urlPattern.format(panel),
+                         panels.panelFilename(args.outdir, panel)))
+            if not args.quiet:
+                print('Fetching', jobs[-1][0])
+        for (url, ofn, status, nBytes) in downloader.downloadAll(session, jobs, max(1, args.jobs),
+                                                                  args.verbose):
+            if isinstance(status, Exception):
+                print('Error fetching', url, status)
+            elif status == 'unchanged':
+                if not args.quiet:
+                    print(ofn, 'is up to date')
+            elif status in ('fetched', 'resumed'):
+                if not args.quiet:
+                    print('Saved', url, 'to', ofn, 'len', nBytes)
+            elif status != 404:
+                print('Error fetching', url, 'status_code', status)
     else:  # Do an update
-        applyUpdate(r.content, ofn, args.verbose)
+        # Each update is streamed to a spool file beside its panel and attached from there
+        jobs = []
+        spools = {}
+        for panel in args.panels:
+            ofn = panels.panelFilename(args.outdir, panel)
+            if not os.path.exists(ofn):
+                print(ofn, 'does not exist to apply an update to')
+                continue
+            url = urlPattern.format(panel)
+            sfn = os.path.join(args.outdir, 'ncds_{}.update.mbtiles'.format(panel))
+            # A spool left by a run that failed to apply it, its validators would make the fetch a 304
+            if os.path.exists(sfn) and not applySpool(changes, panel, sfn, ofn, args.verbose):
+                continue
+            jobs.append((url, sfn))
+            spools[sfn] = (panel, ofn)
+            if not args.quiet:
+                print('Fetching', url)
+        for (url, sfn, status, nBytes) in downloader.downloadAll(session, jobs, max(1, args.jobs)):
+            if isinstance(status, Exception):
+                print('Error fetching', url, status)
+                continue
+            if status not in ('fetched', 'resumed'):
+                print('Error fetching', url, 'status_code', status)
+                continue
+            (panel, ofn) = spools[sfn]
+            applySpool(changes, panel, sfn, ofn, args.verbose)
+
+    # Reindex the panels that were fetched, updated or had tiles deleted
+    coverage = coverageIndex.CoverageIndex(args.coverage or os.path.join(args.outdir, 'coverage.db'))
+    coverage.refresh([fn for fn in (panels.panelFilename(args.outdir, panel)
+                                    for panel in args.panels) if os.path.exists(fn)],
+                     not args.quiet)
+    coverage.close()
+
+
+def fetch(panelNames=None, **options):
+    # Pull full panels from Python, options are the command line's by their dest names
+    args = panels.optionArgs(makeParser(), options)
+    (args.panels, args.full, args.update) = (panelNames, True, False)
+    run(args)
+
+
+def update(panelNames=None, **options):
+    # Apply NOAA's updates and deletes to the panels from Python
+    args = panels.optionArgs(makeParser(), options)
+    (args.panels, args.full, args.update) = (panelNames, False, True)
+    run(args)
+
+
+def main():
+    run(makeParser().parse_args())
+
+
+if __name__ == "__main__":
+    main()
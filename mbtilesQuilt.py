@@ -4,16 +4,33 @@
 #
 # Feb-2019, Pat Welch, pat@mousebrains.com
 #
+# numpy, PIL and pngEncode are imported by the functions using them, so the
+# module can be imported, and --help answered, without loading them.
+#
+# From Python: mbtilesQuilt.quilt(['01a', '01b'], indir='MBTILES', workers=8)
+#
 
 import os
 import os.path
 import io
 import argparse
-import numpy as np
-from tempfile import NamedTemporaryFile
-import sqlite3
-from PIL import Image
-from PIL.PngImagePlugin import PngInfo
+import heapq
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+
+import changeLog
+import coverageIndex
+import panels
+import renderCache
+import quiltStats
+import tileClassifier
+import tileManifest
+import tileOutput
+import tileSource
+import tileStage
 
 transparent = True
 colors = [
@@ -21,197 +38,722 @@ colors = [
     [0xEF, 0xD8, 0xA3]
 ]
 
-def mergeImage(ofn, png, qVerbose):
-    # merge pngBlob into existing image
-    if qVerbose:
-        print('Merging', ofn, len(png))
-    im0 = Image.open(ofn).convert('RGBA')
-    im1 = Image.open(io.BytesIO(png)).convert('RGBA')
-    im2 = Image.alpha_composite(im0, im1)
-    im3, hasData = makeImageColorTransparent(im2)
-    return (im3, hasData)
+def packColors(colors):
+    # Pack RGB triplets the way the RGB of an RGBA pixel reads as a little endian uint32
+    import numpy as np
+    return np.array([r | (g << 8) | (b << 16) for (r, g, b) in colors], dtype='<u4')
+
+packedColors = None # colors packed by packColors, made on first use
+
+def setTransparentColors(newColors):
+    # Replace the list of background colors made transparent
+    global colors, packedColors
+    colors = [list(color) for color in newColors]
+    packedColors = packColors(colors)
 
 
+def parseColor(text):
+    # 'F4E8C1' -> [0xF4, 0xE8, 0xC1]
+    text = text.lstrip('#')
+    if len(text) != 6:
+        raise argparse.ArgumentTypeError('Color {} is not RRGGBB'.format(text))
+    return [int(text[i:i+2], 16) for i in (0, 2, 4)]
+
 
 def makeImageColorTransparent(image):
     # make all instances of a given color transparent
-    # image must be RGBA. 
+    # image must be RGBA, its alpha band is rewritten in place.
     # returns image and bool indicating image has non-transparent data
+    # All colors are matched in one pass by viewing each pixel as a packed
+    # uint32, if nothing is left the image is returned untouched.
+    global packedColors
+    import numpy as np
+    from PIL import Image
     if not transparent:
-        return image
+        return (image, image.getchannel('A').getbbox() is not None)
+    if packedColors is None:
+        packedColors = packColors(colors)
     array = np.array(image, dtype=np.ubyte)
-    h, w, z = array.shape
-    mask = array[:, :, -1] == 0 # original alpha 
-    for color in colors:
-        mask |= (array[:,:,:3] == color).all(axis=2)
-    alpha = np.where(mask, 0, 255)
-    array[:,:,-1] = alpha
-    hasData = alpha.max() > 0
-    imageOut = Image.fromarray(np.ubyte(array))
-    return (imageOut, hasData)
+    mask = array[:, :, 3] == 0 # original alpha
+    pixels = array.view('<u4')[:, :, 0]
+    pixels &= 0x00FFFFFF # drop alpha, leaving packed RGB
+    mask |= np.isin(pixels, packedColors)
+    if mask.all():
+        return (image, False)
+    alpha = np.logical_not(mask).view(np.ubyte)
+    alpha *= 255
+    image.putalpha(Image.fromarray(alpha))
+    return (image, True)
 
 
 def makePngColorTransparent(png):
     # make all instances of a given color transparent
+    from PIL import Image
     image = Image.open(io.BytesIO(png)).convert("RGBA")
     imageOut, hasData = makeImageColorTransparent(image)
     return (imageOut, hasData)
 
 
 def addMetadataAndSave(ofn, image = None, metadata = None):
-    # add metadata to a png
-    if image:
-        targetImage = image
+    # add metadata to a png, encoded and written in one pass
+    from PIL import Image
+    if image is None:
+        image = Image.open(ofn).convert("RGBA")
+    with open(ofn, 'wb') as fp:
+        fp.write(encodeTile(image, metadata))
+
+
+encoder = None # How quilted tiles are encoded, see setEncoder
+
+
+def setEncoder(palette=None, compressLevel=6, optimize=False):
+    # palette is a list of [r, g, b], None for PIL's adaptive palette
+    global encoder
+    import pngEncode
+    encoder = pngEncode.TileEncoder(palette, compressLevel, optimize)
+
+
+def getEncoder():
+    # The encoder set by setEncoder, PIL's adaptive palette if it was not called
+    if encoder is None:
+        setEncoder()
+    return encoder
+
+
+def encodeTile(image, metadata=None):
+    # png bytes of a quilted tile, with the metadata text if given
+    return getEncoder().encode(image, metadata)
+
+
+def planTiles(sources, nWorkers=1, worker=0, region=None, stats=quiltStats.noStats,
+              indices=None, after=None):
+    # Streams the cross panel tile index with every panel's tile
+    # yields ((zoom, column, row), [(panel index, blob, meta), ...]) in panel order
+    # indices, if given, are the only panels read
+    # after, if given, is the last tile already quilted, the plan starts past it
+    # Each panel's tiles arrive sorted, so a k-way merge streams the index
+    # holding only a batch of rows per panel in memory.
+    def tagged(source, index):
+        rows = source.tiles(nWorkers, worker, region, after)
+        while True:
+            t0 = time.perf_counter()
+            item = next(rows, None)
+            if item is None:
+                return
+            (zoom, column, row, blob, meta) = item
+            stats.panelRead(index, len(blob), time.perf_counter() - t0)
+            yield ((zoom, column, row), index, blob, meta)
+    if indices is None:
+        indices = range(len(sources))
+    merged = heapq.merge(*[tagged(sources[index], index) for index in indices])
+    for key, items in itertools.groupby(merged, key=lambda item: item[0]):
+        yield (key, [(index, blob, meta) for (k, index, blob, meta) in items])
+
+
+def lookupLayers(sources, key, stats=quiltStats.noStats, indices=None):
+    # Every panel's tile at key, as planTiles yields them
+    # indices, if given, are the only panels looked in
+    layers = []
+    if indices is None:
+        indices = range(len(sources))
+    for index in indices:
+        t0 = time.perf_counter()
+        result = sources[index].tile(*key)
+        if result is not None:
+            stats.panelRead(index, len(result[0]), time.perf_counter() - t0)
+            layers.append((index,) + result)
+    return layers
+
+
+def isNoOpLayer(solid):
+    # A uniform layer that is transparent, or opaque background, never
+    # leaves data when merged, so it cannot change the tile
+    (width, height, rgba) = solid
+    if rgba[3] == 0:
+        return True
+    return transparent and rgba[3] == 255 and list(rgba[:3]) in colors
+
+
+def compositeTile(layers, base=None, classifier=None, stats=quiltStats.noStats):
+    # Decode every contributing layer once and alpha composite them in memory
+    # A layer is png bytes, or (width, height, rgba) for a uniform tile
+    # If base, the png bytes of an existing tile, is given it is the bottom layer
+    # Layers are applied as merging one panel at a time would, a layer whose
+    # merge leaves no data does not replace what is underneath it.
+    # returns image and bool indicating image has non-transparent data
+    from PIL import Image
+    image = None
+    hasData = False
+    if base is not None:
+        with stats.stage('decode'):
+            image = Image.open(io.BytesIO(base)).convert('RGBA')
+    for png in layers:
+        with stats.stage('decode'):
+            if isinstance(png, tuple):
+                (width, height, rgba) = png
+                layer = Image.new('RGBA', (width, height), rgba)
+            else:
+                layer = Image.open(io.BytesIO(png)).convert('RGBA')
+                if classifier is not None:
+                    classifier.learn(png, layer)
+        if image is not None:
+            with stats.stage('composite'):
+                layer = Image.alpha_composite(image, layer)
+        with stats.stage('mask'):
+            layer, layerHasData = makeImageColorTransparent(layer)
+        if layerHasData:
+            image = layer
+            hasData = True
+    return (image, hasData)
+
+
+def tileMetadata(metadataUnits, zoom, meta):
+    # metadata text for a tile, returns (skip, metadata)
+    # meta is the tile's map grid_id in oldFormatMBTiles panels
+    if metadataUnits == "feet":
+        return (False, ' {"units": "feet"}')
+    if metadataUnits == "metric":
+        return (False, ' {"units": "metric"}')
+    if metadataUnits == "oldFormatMBTiles":
+        if zoom <= 7:
+            return (True, None)
+        return (False, meta if meta else None)
+    return (False, None)
+
+
+def tileLayers(args, key, layers, classifier=None, stats=quiltStats.noStats):
+    # The layers each panel contributes to a tile, bottom first, and the tile's metadata
+    # layers are (panel index, blob, meta) as planTiles yields them
+    (zoom, column, row) = key
+    pngs = []
+    metadata = None
+    for (index, png, meta) in layers:
+        if len(png) in [190, # transparent
+                        # 177, # pure orange background
+                        # 355 pure white
+                        ]:
+            continue
+        (skip, meta) = tileMetadata(args.metadataUnits, zoom, meta)
+        if skip:
+            continue
+        metadata = meta # Last panel wins, as when merging one panel at a time, even a no-op one
+        solid = classifier.classify(png) if classifier is not None else None
+        if solid is not None:
+            if isNoOpLayer(solid): # Known empty or background, no need to decode it
+                continue
+            png = solid
+        pngs.append(png)
+    stats.count('layers', len(layers))
+    stats.count('layersSkipped', len(layers) - len(pngs))
+    return (pngs, metadata)
+
+
+def topLayer(args, key, layers, classifier=None):
+    # The topmost of layers that leaves data on its own, as a list of it, or []
+    # Overwriting one panel at a time kept the last panel whose tile was not masked away.
+    for layer in reversed(layers):
+        (pngs, metadata) = tileLayers(args, key, [layer], classifier)
+        if pngs and compositeTile(pngs, classifier=classifier)[1]:
+            return [layer]
+    return []
+
+
+def renderTile(args, key, sources, classifier=None, indices=None):
+    # png bytes of one tile composited from the panels, or None if it has no data
+    (pngs, metadata) = tileLayers(args, key, lookupLayers(sources, key, indices=indices), classifier)
+    if not pngs:
+        return None
+    image, hasData = compositeTile(pngs, classifier=classifier)
+    return encodeTile(image, metadata) if hasData else None
+
+
+def renderSettings(args):
+    # Everything besides the source blobs that changes how a tile comes out
+    return 'colors={} transparent={} metadataUnits={} merge={} {}'.format(
+            colors, transparent, args.metadataUnits, args.merge, getEncoder().settings())
+
+
+def stageSettings(args):
+    # Everything a staged version must be resumed with, panels as they were when it started
+    return json.dumps({'panels': [(panel, coverageIndex.panelStamp(panels.panelFilename(args.indir, panel)))
+                                  for panel in args.panels],
+                       'render': renderSettings(args), 'region': args.region,
+                       'incremental': args.incremental, 'workers': max(1, args.workers),
+                       'flip_y': args.flip_y})
+
+
+class TileJob(object):
+    # One tile between prepareTile and saveTile
+    # current is the tile in the output, read when merging or checking the manifest
+
+    def __init__(self, key, pngs=(), metadata=None, base=None, current=None,
+                 source=None, cacheKey=None):
+        self.key = key
+        self.pngs = pngs
+        self.metadata = metadata
+        self.base = base
+        self.current = current
+        self.source = source
+        self.cacheKey = cacheKey
+
+
+def quiltTile(args, key, layers, output, classifier=None, replace=False, cache=None,
+              stats=quiltStats.noStats, manifest=None):
+    # Composite every panel's contribution to one output tile and save it
+    # If replace, any existing output is recomposited from scratch, and
+    # removed when no panel leaves data in the tile any more.
+    # With a RenderCache, a tile made from the same sources before is reused.
+    # With a TileManifest, a tile is left alone if it would come out the same.
+    # returns True if the tile was written
+    (written, job) = prepareTile(args, key, layers, output, classifier, replace, cache, stats,
+                                 manifest)
+    if job is None:
+        return written
+    image, hasData = compositeTile(job.pngs, job.base, classifier, stats)
+    return saveTile(args, job, image if hasData else None, output, replace, cache, stats,
+                    manifest)
+
+
+def prepareTile(args, key, layers, output, classifier=None, replace=False, cache=None,
+                stats=quiltStats.noStats, manifest=None):
+    # Everything quiltTile does ahead of compositing
+    # returns (written, None) if the tile was settled without compositing,
+    # else (None, TileJob) for compositeTile and then saveTile
+    (zoom, column, row) = key
+    if not args.merge: # Overwrite, the last panel leaving data wins
+        layers = topLayer(args, key, layers, classifier)
+    (pngs, metadata) = tileLayers(args, key, layers, classifier, stats)
+    job = TileJob(key, pngs, metadata)
+    if not pngs:
+        return (writeTile(args, job, None, output, replace, stats, manifest), None)
+
+    if manifest is not None or (args.merge and not replace):
+        with stats.stage('outputRead'):
+            job.current = output.read(zoom, column, row)
+    if manifest is not None:
+        job.source = manifest.key(renderSettings(args), pngs, metadata)
+        if manifest.unchanged(key, job.source, job.current): # Made from the same sources last time
+            stats.count('unchanged')
+            return (False, None)
+    if args.merge and not replace:
+        job.base = job.current
+    if job.base is not None: # Merge into a tile from a previous run
+        if args.verbose:
+            print('Merging', key, len(pngs))
+    if cache is not None:
+        job.cacheKey = cache.key(renderSettings(args), pngs, job.base, metadata)
+        (found, path) = cache.get(job.cacheKey)
+        if found and path is None: # Cached as having no data
+            return (writeTile(args, job, None, output, replace, stats, manifest), None)
+        if found and manifest is not None:
+            with open(path, 'rb') as fp:
+                cached = fp.read()
+            if cached == job.current:
+                manifest.record(key, job.source, job.current, False)
+                stats.count('unchanged')
+                return (False, None)
+            manifest.record(key, job.source, cached)
+        if found:
+            with stats.stage('write'):
+                output.link(zoom, column, row, path)
+            stats.count('cacheHits')
+            stats.count('merged' if job.base is not None else 'new')
+            return (True, None)
+    return (None, job)
+
+
+def saveTile(args, job, image, output, replace=False, cache=None, stats=quiltStats.noStats,
+             manifest=None):
+    # Encode and write the composited image of a TileJob, None if it has no data
+    # returns True if the tile was written
+    png = None
+    if image is not None:
+        with stats.stage('encode'):
+            png = encodeTile(image, job.metadata)
+    if job.cacheKey is not None:
+        cache.put(job.cacheKey, png)
+    return writeTile(args, job, png, output, replace, stats, manifest)
+
+
+def writeTile(args, job, png, output, replace=False, stats=quiltStats.noStats, manifest=None):
+    # Write a tile's png, or if it is None remove a tile no longer covered when replacing
+    # returns True if the tile was written
+    (zoom, column, row) = job.key
+    if png is None:
+        stats.count('skipped')
+        if replace and output.remove(zoom, column, row): # No longer covered
+            stats.count('removed')
+            if manifest is not None:
+                manifest.record(job.key, job.source, None)
+            if args.verbose:
+                print('Removing', job.key)
+        return False
+
+    if manifest is not None:
+        if png == job.current: # Recomposited into the bytes already there
+            manifest.record(job.key, job.source, png, False)
+            stats.count('unchanged')
+            return False
+        manifest.record(job.key, job.source, png)
+    with stats.stage('write'):
+        output.write(zoom, column, row, png)
+    stats.count('merged' if job.base is not None else 'new')
+    return True
+
+
+def openOutput(args):
+    if args.mbtiles:
+        return tileOutput.TileArchive(args.mbtiles)
+    return tileOutput.TileTree(args.outdir, args.flip_y, args.store)
+
+
+def quiltWorker(args, nWorkers=1, worker=0):
+    # Quilt one shard of the output tiles from all the panels
+    # Only tiles whose row falls in this worker's shard are touched, so a
+    # given output tile, and its Z/row directory, is owned by one worker.
+    # returns (number of tiles written, stats report or None)
+    setTransparentColors(args.colors)
+    setEncoder(args.palette, args.compressLevel, args.optimize)
+    classifier = tileClassifier.TileClassifier(args.uniformCache)
+    region = None
+    if args.region:
+        import tileIsInPolygon # shapely is only needed for regions
+        region = tileIsInPolygon.TileRegion(tileIsInPolygon.loadPolygon(args.region))
+    output = openOutput(args)
+    cache = None
+    if args.renderCache:
+        cache = renderCache.RenderCache(args.renderCache, args.renderCacheMB * 1024 * 1024)
+    manifest = None
+    if args.manifest:
+        manifest = tileManifest.TileManifest(args.manifest, args.manifestRun,
+                                             resumed=args.manifestResumed)
+    sources = []
+    for panel in args.panels:
+        fn = panels.panelFilename(args.indir, panel)
+        if not args.quiet:
+            print('Opening', fn)
+        sources.append(tileSource.TileSource(fn, args.metadataUnits == "oldFormatMBTiles"))
+    coverage = coverageIndex.openIfFresh(args.coverage, [source.fn for source in sources])
+    panelIndex = {panel: index for (index, panel) in enumerate(args.panels)}
+    if coverage is not None and not args.quiet:
+        print('Worker', worker, 'using panel coverage from', args.coverage)
+    stats = quiltStats.noStats
+    if args.stats:
+        stats = quiltStats.QuiltStats(args.panels, worker, args.statsInterval)
+    checkpoint = None
+    (after, count) = (None, 0)
+    if args.checkpoint: # Staged, carry on past the last tile finished
+        checkpoint = tileStage.Checkpoint(args.checkpoint)
+        (after, count) = checkpoint.get(worker)
+        if after is not None and not args.quiet:
+            print('Worker', worker, 'resuming after', after, 'with', count, 'tiles written')
+    changes = None
+    if args.incremental: # Only the tiles changed by mbtilesFetch.py --update, from every panel
+        changes = changeLog.openChangeLog(args.changelog)
+        def covering(key): # Only the panels with a tile there, bottom first as in args.panels
+            if coverage is None:
+                return None
+            return sorted(panelIndex[panel] for panel in coverage.covering(*key) if panel in panelIndex)
+        plan = ((key, lookupLayers(sources, key, stats, covering(key)))
+                for key in map(tuple, changeLog.changedTiles(changes, nWorkers, worker))
+                if (region is None or region.contains(*key)) and (after is None or key > after))
     else:
-        targetImage = Image.open(ofn)
-    metainfo = PngInfo()
-    metainfo.add_text("meta", metadata)
-    targetImage.save(ofn, pnginfo=metainfo)
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('panels', nargs='*', default=None, help='MTiles files to process')
-verbose = parser.add_mutually_exclusive_group()
-verbose.add_argument('--verbose', action='store_true', default=True,
-                     help='Output diagnositcs')
-verbose.add_argument('--quiet', action='store_false', default=False,
-                     help='No non-error output')
-parser.add_argument('--indir', default='RNC_ROOT',
-                    help='input files')
-parser.add_argument('--outdir', default='RNC_ROOT',
-                    help='where to write output to')
-parser.add_argument('--flip_y', default=True,
-                    help='Flip Y axis for non-TMS servers')
-parser.add_argument('--metadataUnits', default="feet",
-                    choices=["feet", "metric", "oldFormatMBTiles"],
-                    help='Add metadata depth units')
-parser.add_argument('--merge', default=True,
-                    help='Enable merging of tiles - otherwise overwrite')
-
-args = parser.parse_args()
-
-if len(args.panels) == 0:
-    args.panels = [
-                    "01a",
-                    "01b",
-                    "01c", # 2024.06.01
-                    "02a",
-                    "02b",
-                    "03",
-                    "04",
-                    "05",
-                    "06",
-                    "07",
-                    "08",
-                    "09",
-                    "10",
-                    "11",
-                    "12",
-                    "13",
-                    "14",
-                    "15",
-                    "16",
-                    "17a",
-                    "17b",
-                    "18",
-                    "19a", # renamed from "19" 2024.06.01
-                    "19b",
-                    "19c",
-                    "19d",
-                    "20a",
-                    "20b",
-                    "20c", # seattle
-                    "21",
-                    "22a",
-                    "22b",
-                    "23a",
-                    "23b",
-                    "24a",
-                    "24b",
-                    "25a",
-                    "25b",
-                    "26a",
-                    "26b",
-                    "27",
-                    "28a",
-                    "28b",
-                    "29",
-                    "30",
-                    "31a",
-                    "31b"
-                    ]
-
-for panel in args.panels:
-    fn = os.path.join(args.indir, "ncds_{}.mbtiles".format(panel))
-    count = 0
-    if not args.quiet:
-        print('')
-        print('Opening', fn)
-    with sqlite3.connect(fn) as conn:
-        with sqlite3.connect(fn) as conn_meta:
-            results = conn.execute('SELECT * FROM tiles;')
-            for result in results:  # Walk over rows
-                (zoom, column, row, png) = result
-
-                imSize = len(png)
-                if imSize in [190, # transparent
-                              # 177, # pure orange background
-                              # 355 pure white
-                              ]:  
-                    continue
-
-                
-
-                metadata = None
-                if args.metadataUnits == "feet":
-                    metadata = ' {"units": "feet"}'
-                elif args.metadataUnits == "metric":
-                    metadata = ' {"units": "metric"}'
-                elif args.metadataUnits == "oldFormatMBTiles":
-                    if zoom <= 7:
-                        continue
-                    metas = conn_meta.execute("SELECT * FROM map WHERE zoom_level = " + str(zoom) + " AND tile_column = " + str(column) + " AND tile_row = " + str(row) + ";")
-                    kj = None
-                    for meta in metas:
-                        (z, c, r, kn, kj) = meta
-                    if kj:
-                        metadata = kj
-
-                # jayb Y is inverted in TMS (default format for MBTiles)
-                if args.flip_y:
-                    row = (2 ** zoom) - (1 + row)
-                odir = os.path.join(args.outdir, 'Z' + str(zoom), str(row)).replace("\\","/")
-                ofn = os.path.join(odir, '{}.png'.format(column)).replace("\\","/")
-
-                if not os.path.isdir(odir):
-                    # if args.verbose:
-                    #   print('Making directory', odir)
-                    os.makedirs(odir)
+        indices = None
+        if region is not None and coverage is not None: # Skip panels with nothing in the region
+            indices = [index for (index, panel) in enumerate(args.panels)
+                       if any(region.bounds(zoom) is not None and
+                              coverage.intersects(panel, zoom, region.bounds(zoom))
+                              for zoom in coverage.zooms(panel))]
+        plan = planTiles(sources, nWorkers, worker, region, stats, indices, after)
+    pipeline = None
+    if args.pipeline: # Compositors forked before the reader thread starts
+        import quiltPipeline
+        pipeline = quiltPipeline.Pipeline(args, output, classifier, args.incremental, cache, stats,
+                                          manifest, args.pipeline)
+        plan = quiltPipeline.readAhead(plan)
+    def tally(written): # Tiles finish out of order in the pipeline
+        nonlocal count
+        for isWritten in written:
+            if isWritten:
                 count = count + 1
-                if count % 100 == 0:
+                if count % 100 == 0 and not args.stats: # --stats prints progress lines instead
                     print(".", end='')
                     if count % 10000 == 0:
-                        print(count, panel) # newline
-
-                if args.merge and os.path.exists(ofn):
-                        image, hasData = mergeImage(ofn, png, args.verbose)
-                        if hasData:
-                            if (metadata is None):
-                                image.convert('P').save(ofn)
-                            else:
-                                addMetadataAndSave(ofn, image, metadata)
-                else:  # Does not exist
-                    if args.verbose:
-                        j = 1
-                        # print('Saving', ofn, 'length', len(png))
-                    if metadata is None:
-                        image = Image.open(io.BytesIO(png)).convert("RGBA")
-                        imageOut, hasData = makeImageColorTransparent(image)
-                        if hasData:
-                            imageOut.convert('P').save(ofn)
-                    else:
-                        image = Image.open(io.BytesIO(png)).convert("RGBA")
-                        imageOut, hasData = makeImageColorTransparent(image)
-                        if hasData:
-                            imageOut = imageOut.convert('P')
-                            addMetadataAndSave(ofn, imageOut, metadata)
+                        print(count, worker) # newline
+    key = None
+    try:
+        for (nTiles, (key, layers)) in enumerate(plan, 1):
+            stats.count('tiles')
+            stats.progress()
+            if pipeline is None:
+                tally([quiltTile(args, key, layers, output, classifier, args.incremental, cache,
+                                 stats, manifest)])
+            else:
+                tally(pipeline.quilt(key, layers))
+            if checkpoint is not None and nTiles % args.checkpointEvery == 0:
+                if pipeline is not None: # Every tile up to key finished
+                    tally(pipeline.drain())
+                if manifest is not None: # Recorded before the tiles are skipped on resuming
+                    manifest.flush()
+                checkpoint.save(worker, key, count)
+        if pipeline is not None:
+            tally(pipeline.drain())
+        if checkpoint is not None and key is not None:
+            if manifest is not None:
+                manifest.flush()
+            checkpoint.save(worker, key, count)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        for source in sources:
+            source.close()
+        if changes is not None:
+            changes.close()
+        if coverage is not None:
+            coverage.close()
+        with stats.stage('write'): # pending archive writes
+            output.close()
+        classifier.save()
+        if cache is not None:
+            cache.close()
+        if manifest is not None:
+            manifest.close()
+    if not args.quiet:
+        print('')
+        print('Worker', worker, 'recognized', classifier.hits, 'uniform tiles without decoding')
+        if cache is not None:
+            print('Worker', worker, 'render cache hits', cache.hits, 'misses', cache.misses,
+                  '({:.1f}% hit rate)'.format(cache.hitRate()))
+    stats.count('uniformLayers', classifier.hits)
+    return (count, stats.report())
+
+
+def makeParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('panels', nargs='*', default=None, help='MTiles files to process')
+    verbose = parser.add_mutually_exclusive_group()
+    verbose.add_argument('--verbose', action='store_true', default=True,
+                         help='Output diagnositcs')
+    verbose.add_argument('--quiet', action='store_false', default=False,
+                         help='No non-error output')
+    parser.add_argument('--indir', default='RNC_ROOT',
+                        help='input files')
+    parser.add_argument('--outdir', default='RNC_ROOT',
+                        help='where to write output to')
+    parser.add_argument('--discover', action='store_true',
+                        help='With no panels given, quilt every ncds_*.mbtiles in indir rather than the default list')
+    parser.add_argument('--mbtiles',
+                        help='Write the tiles into this MBTiles file instead of a tree under outdir')
+    parser.add_argument('--store',
+                        help='Keep each distinct tile image once in this directory, the tree\'s tiles are hard links to it.'
+                        ' It must be on the same filesystem as outdir')
+    parser.add_argument('--flip_y', default=True,
+                        help='Flip Y axis for non-TMS servers')
+    parser.add_argument('--metadataUnits', default="feet",
+                        choices=["feet", "metric", "oldFormatMBTiles"],
+                        help='Add metadata depth units')
+    parser.add_argument('--merge', default=True,
+                        help='Enable merging of tiles - otherwise overwrite')
+    parser.add_argument('--colors', nargs='+', type=parseColor,
+                        default=[[0xF4, 0xE8, 0xC1], [0xEF, 0xD8, 0xA3]],
+                        help='Background colors, as RRGGBB, to make transparent')
+    parser.add_argument('--uniformCache',
+                        help='SQLite file of tiles known to be one color, default indir/uniformTiles.db unless indir is read only')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only recomposite the tiles changed since the last mbtilesFetch.py --update')
+    parser.add_argument('--changelog',
+                        help='Change log written by mbtilesFetch.py --update, default indir/changes.db')
+    parser.add_argument('--coverage',
+                        help='Panel coverage index from coverageIndex.py, default indir/coverage.db, used if up to date')
+    parser.add_argument('--region',
+                        help='GeoJSON polygon, only the tiles whose centers are inside it are quilted')
+    parser.add_argument('--renderCache',
+                        help='Directory of quilted tiles kept between runs, reused when their sources are unchanged')
+    parser.add_argument('--renderCacheMB', type=int, default=10240,
+                        help='Size the render cache is trimmed to after a run')
+    parser.add_argument('--palette',
+                        help='JSON palette from pngEncode.py, default adapt a palette to each tile')
+    parser.add_argument('--compressLevel', type=int, default=6, choices=range(10),
+                        help='zlib level for the output tiles, 1 fastest to 9 smallest')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Search for the smallest encoding of each tile, slower')
+    parser.add_argument('--stage', action='store_true',
+                        help='Quilt into a new version in outdir.versions and publish it by pointing the outdir symlink at it, resuming a killed quilt')
+    parser.add_argument('--keepVersions', type=int, default=3,
+                        help='With --stage, finished versions kept after publishing')
+    parser.add_argument('--checkpointEvery', type=int, default=1000,
+                        help='With --stage, tiles between checkpoints')
+    parser.add_argument('--manifest',
+                        help='SQLite record of how each tile was made, tiles that would come out the same are not rewritten')
+    parser.add_argument('--changedList',
+                        help='With --manifest, write the paths of the tiles this run changed to this file, for rsync --files-from')
+    parser.add_argument('--stats',
+                        help='Write a JSON report of the time spent in each stage to this file')
+    parser.add_argument('--statsInterval', type=float, default=30,
+                        help='Seconds between progress lines with --stats, 0 for none')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes, each owning a disjoint set of output tiles')
+    parser.add_argument('--pipeline', type=int, default=0,
+                        help='With one worker, composite in this many processes fed by a panel reader thread'
+                        ' and drained by an encoder, passing pixels in shared memory')
+    return parser
+
+
+def prepareArgs(args):
+    # Fill in the defaults that depend on other options
+    # raises ValueError if there is no change log to quilt incrementally from
+    args.panels = panels.resolvePanels(args.panels, args.indir if args.discover else None)
+
+    if args.uniformCache is None:
+        args.uniformCache = tileClassifier.defaultCache(args.indir)
+
+    if args.palette is not None and not isinstance(args.palette, list): # Loaded once, workers get the colors
+        import pngEncode
+        args.palette = pngEncode.loadPalette(args.palette)
+
+    if args.coverage is None:
+        args.coverage = os.path.join(args.indir, 'coverage.db')
+
+    if args.changelog is None:
+        args.changelog = os.path.join(args.indir, 'changes.db')
+    if args.incremental and not os.path.exists(args.changelog):
+        raise ValueError('No change log {} to quilt incrementally from'.format(args.changelog))
+
+    if args.stage and args.mbtiles:
+        raise ValueError('--stage versions a tree, not an --mbtiles archive')
+    if args.store and args.mbtiles:
+        raise ValueError('--store is for a tree, an --mbtiles archive already keeps each image once')
+    if args.pipeline and args.workers > 1:
+        raise ValueError('--pipeline composites in processes of its own, use it with --workers 1')
+    if args.pipeline and sys.version_info < (3, 8):
+        raise ValueError('--pipeline needs multiprocessing.shared_memory, Python 3.8 or later')
+    return args
+
+
+def run(args):
+    # Quilt args.panels, as prepared by prepareArgs
+    # returns the number of tiles written
+    if args.incremental:
+        with changeLog.openChangeLog(args.changelog) as conn:
+            (nPanels, nChanges) = changeLog.countChanges(conn)
+        if not args.quiet:
+            print('Recompositing', nChanges, 'changed tiles from', nPanels, 'updated panels')
+
+    # Loaded before the pool forks, so the workers inherit the modules rather than import them again
+    setTransparentColors(args.colors)
+    setEncoder(args.palette, args.compressLevel, args.optimize)
+    if args.region:
+        import tileIsInPolygon
+
+    (args.checkpoint, publishdir) = (None, args.outdir)
+    if args.stage: # Quilt into a version of outdir, from its checkpoints if it was started before
+        # Only a quilt of some of the tiles starts from the published ones, a full quilt rebuilds
+        (version, args.outdir, args.checkpoint, resumed) = tileStage.stageVersion(
+                publishdir, stageSettings(args), bool(args.incremental or args.region), not args.quiet)
+
+    (args.manifestRun, args.manifestResumed) = (None, False)
+    if args.manifest:
+        checkpoint = tileStage.Checkpoint(args.checkpoint) if args.checkpoint else None
+        if checkpoint is not None: # A resumed version carries on its run, so the list covers all it wrote
+            args.manifestRun = checkpoint.manifestRun()
+            args.manifestResumed = args.manifestRun is not None
+        if args.manifestRun is None:
+            manifest = tileManifest.TileManifest(args.manifest)
+            args.manifestRun = manifest.startRun(renderSettings(args))
+            manifest.close()
+            if checkpoint is not None:
+                checkpoint.setManifestRun(args.manifestRun)
+        if checkpoint is not None:
+            checkpoint.close()
+
+    nWorkers = max(1, args.workers)
+    t0 = time.perf_counter()
+    if nWorkers == 1:
+        results = [quiltWorker(args)]
+    else:
+        with multiprocessing.Pool(nWorkers) as pool:
+            results = pool.starmap(quiltWorker,
+                                   [(args, nWorkers, worker) for worker in range(nWorkers)])
+    elapsed = time.perf_counter() - t0
+    count = sum(count for (count, report) in results)
+    if not args.quiet:
+        print('')
+        print('Quilted', count, 'tiles with', nWorkers, 'workers')
+    if args.stats:
+        report = quiltStats.combine([report for (count, report) in results], elapsed)
+        with open(args.stats, 'w') as fp:
+            json.dump(report, fp, indent=2)
+        if not args.quiet:
+            print('{} tiles in {:.1f}s, {:.1f} tiles/s, stats in {}'.format(
+                report['counters'].get('tiles', 0), elapsed, report['tilesPerSecond'], args.stats))
+            for (name, seconds) in sorted(report['stages'].items(), key=lambda item: -item[1]):
+                print('  {:10s} {:8.1f}s'.format(name, seconds))
+    if args.manifest:
+        manifest = tileManifest.TileManifest(args.manifest)
+        (written, removed) = manifest.changed(args.manifestRun)
+        manifest.close()
+        if not args.quiet:
+            print('Changed', len(written), 'tiles and removed', len(removed), 'in run', args.manifestRun)
+        if args.changedList:
+            tileManifest.writeList(args.changedList, written,
+                                   None if args.mbtiles else tileOutput.TileTree(args.outdir, args.flip_y))
+    if args.renderCache:
+        cache = renderCache.RenderCache(args.renderCache, args.renderCacheMB * 1024 * 1024)
+        (nRemoved, nBytes) = cache.evict()
+        cache.close()
+        if not args.quiet:
+            print('Render cache holds', nBytes, 'bytes after evicting', nRemoved, 'tiles')
+    if args.mbtiles:
+        archive = tileOutput.TileArchive(args.mbtiles)
+        archive.removeOrphans()
+        (nTiles, nImages) = archive.counts()
+        archive.close()
+        if not args.quiet:
+            print(args.mbtiles, 'has', nTiles, 'tiles and', nImages, 'distinct images')
+    if args.stage: # Every worker finished, so the version is complete
+        tileStage.publish(publishdir, version)
+        removed = tileStage.prune(publishdir, max(1, args.keepVersions))
+        if not args.quiet:
+            print('Published', version, 'as', publishdir, 'removed', len(removed), 'old versions')
+        args.outdir = publishdir
+    if args.store: # After pruning, so the images only old versions used go too
+        store = tileOutput.TileStore(args.store)
+        nOrphans = store.removeOrphans()
+        (nImages, nTiles, nBytes, nSaved) = store.counts()
+        if not args.quiet:
+            print('{} has {} distinct images for {} tiles, dedup ratio {:.2f}, {:.1f}MB saved,'
+                  ' {} unused images removed'.format(args.store, nImages, nTiles,
+                                                     nTiles / nImages if nImages else 1.0,
+                                                     nSaved / 1048576, nOrphans))
+    if args.incremental: # Every worker finished, so the changes are in the output
+        with changeLog.openChangeLog(args.changelog) as conn:
+            if args.region: # Only the changes in the region were, the rest wait for their quilt
+                region = tileIsInPolygon.TileRegion(tileIsInPolygon.loadPolygon(args.region))
+                changeLog.clearTiles(conn, [key for key in map(tuple, changeLog.changedTiles(conn))
+                                            if region.contains(*key)])
+            else:
+                changeLog.clearChanges(conn)
+    return count
+
+
+def quilt(panelNames=None, **options):
+    # Quilt from Python, options are the command line's by their dest names
+    # returns the number of tiles written
+    args = panels.optionArgs(makeParser(), options)
+    args.panels = list(panelNames or [])
+    return run(prepareArgs(args))
+
+
+def main():
+    parser = makeParser()
+    args = parser.parse_args()
+    try:
+        prepareArgs(args)
+    except ValueError as e:
+        parser.error(str(e))
+    run(args)
+
+if __name__ == "__main__":
+    main()
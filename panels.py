@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+#
+# The NOAA RNC panels, and the option handling, shared by mbtilesFetch.py,
+# mbtilesQuilt.py and tileServer.py
+#
+# defaultPanels is the list fetched and quilted when none are given, in the
+# order they are quilted. The panels can also be discovered from the
+# ncds_*.mbtiles files in a directory, or from NOAA's catalog, the index
+# page of the directory the panels are fetched from.
+#
+# Nothing here imports numpy, PIL or requests, so the scripts can parse their
+# command line, and answer --help, before loading them.
+#
+# ./panels.py                   the default list
+# ./panels.py --indir MBTILES   the panels in MBTILES
+# ./panels.py --catalog         the panels NOAA has
+#
+
+import argparse
+import glob
+import os.path
+import re
+
+defaultPanels = [
+    "01a",
+    "01b",
+    "01c", # 2024.06.01
+    "02a",
+    "02b",
+    "03",
+    "04",
+    "05",
+    "06",
+    "07",
+    "08",
+    "09",
+    "10",
+    "11",
+    "12",
+    "13",
+    "14",
+    "15",
+    "16",
+    "17a",
+    "17b",
+    "18",
+    "19a", # renamed from "19" 2024.06.01
+    "19b",
+    "19c",
+    "19d",
+    "20a",
+    "20b",
+    "20c", # seattle
+    "21",
+    "22a",
+    "22b",
+    "23a",
+    "23b",
+    "24a",
+    "24b",
+    "25a",
+    "25b",
+    "26a",
+    "26b",
+    "27",
+    "28a",
+    "28b",
+    "29",
+    "30",
+    "31a",
+    "31b"]
+
+catalogUrl = 'https://distribution.charts.noaa.gov/ncds/mbtiles/'
+panelPattern = re.compile(r'ncds_(\w+)\.mbtiles')
+
+
+def panelFilename(indir, panel):
+    return os.path.join(indir, 'ncds_{}.mbtiles'.format(panel))
+
+
+def discoverPanels(indir):
+    # The panels with a file in indir, names sort in the order they are quilted
+    panels = []
+    for fn in glob.glob(os.path.join(indir, 'ncds_*.mbtiles')):
+        match = panelPattern.fullmatch(os.path.basename(fn))
+        if match:
+            panels.append(match.group(1))
+    return sorted(panels)
+
+
+def catalogPanels(url=catalogUrl, session=None):
+    # The panels linked from NOAA's index page
+    if session is None:
+        import downloader # requests is only needed to ask NOAA
+        session = downloader.makeSession(1)
+        timeout = downloader.timeout
+    else:
+        timeout = 60
+    r = session.get(url, timeout=timeout)
+    r.raise_for_status()
+    return sorted(set(panelPattern.findall(r.text)))
+
+
+def resolvePanels(panels=None, indir=None, catalog=False):
+    # The panels given, else those in indir, from NOAA's catalog, or the default list
+    if panels:
+        return list(panels)
+    if indir is not None:
+        return discoverPanels(indir)
+    if catalog:
+        return catalogPanels()
+    return list(defaultPanels)
+
+
+def optionArgs(parser, options):
+    # The parser's defaults with options, by their dest names, in their place,
+    # for calling a script's work from Python as its command line would
+    args = parser.parse_args([])
+    for (name, value) in options.items():
+        if not hasattr(args, name):
+            raise TypeError('Unknown option {!r}'.format(name))
+        setattr(args, name, value)
+    return args
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List the RNC panels')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--indir', help='List the panels with files in this directory')
+    source.add_argument('--catalog', action='store_true', help='List the panels NOAA has')
+    args = parser.parse_args()
+
+    print(' '.join(resolvePanels(indir=args.indir, catalog=args.catalog)))
+
+
+if __name__ == "__main__":
+    main()
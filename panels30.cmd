@@ -1,3 +0,0 @@
-rem 01a 01b 01c 02a 02b 03 04 05 06 07 08 09 10 11 12 13 14 15 16 17a 17b 18 19a 19b 19c 19d 20a 20b 20c 21 22a 22b 23a 23b 24a 24b 25a 25b 26a 26b 27 28a 28b 29 30 31a 31b
-
-python mbtilesQuilt.py --indir D:/DeepZoom/NOAA.RNC.Fetch --outdir D:/DeepZoom/NOAA.RNC.Tiles/feet  30 31a 31b
\ No newline at end of file
@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+#
+# Encode quilted tiles as palette PNGs
+#
+# Without a palette each tile is quantized adaptively by PIL, as before.
+# With a fixed palette of the RNC chart colors, quantizing is a table lookup
+# of each pixel's packed RGB, colors missing from the palette are matched to
+# their nearest entry once. Index 0 is reserved for transparent pixels,
+# quilted tiles are either transparent or opaque.
+#
+# ./pngEncode.py --palette rncPalette.json MBTILES/ncds_*.mbtiles
+#   builds a palette of the most common colors in a sample of the panels' tiles
+#
+
+import argparse
+import collections
+import io
+import json
+import sqlite3
+import numpy as np
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+
+def loadPalette(fn):
+    # list of [r, g, b] from a JSON list of 'RRGGBB'
+    with open(fn, 'r') as fp:
+        return [[int(c[i:i+2], 16) for i in (0, 2, 4)] for c in json.load(fp)]
+
+
+def savePalette(fn, palette):
+    with open(fn, 'w') as fp:
+        json.dump(['{:02X}{:02X}{:02X}'.format(r, g, b) for (r, g, b) in palette], fp, indent=0)
+
+
+def packRGB(array):
+    # (..., 4) uint8 RGBA -> (...) uint32 of the RGB, read as a little endian uint32
+    pixels = np.ascontiguousarray(array, dtype=np.uint8).view('<u4')[..., 0]
+    return pixels & 0x00FFFFFF
+
+
+def unpackRGB(packed):
+    return [[int(c) & 0xFF, (int(c) >> 8) & 0xFF, (int(c) >> 16) & 0xFF] for c in packed]
+
+
+class TileEncoder(object):
+    # png bytes from RGBA tiles, with a fixed palette or adaptive quantization
+    # With a palette, a 16MB table maps every packed RGB to its palette index,
+    # 0 until the color is first seen, then the nearest entry is remembered.
+
+    def __init__(self, palette=None, compressLevel=6, optimize=False):
+        self.compressLevel = compressLevel
+        self.optimize = optimize
+        self.palette = palette
+        if palette is not None:
+            if len(palette) > 255:
+                raise ValueError('Palette has {} colors, at most 255 fit beside transparent'.format(
+                    len(palette)))
+            colors = np.array(palette, dtype=np.uint8).reshape(-1, 3)
+            self.colors = colors.astype(np.int32)
+            self.pngPalette = [0, 0, 0] + [int(v) for v in colors.ravel()] # index 0 is transparent
+            self.lut = np.zeros(1 << 24, dtype=np.uint8)
+            rgba = np.concatenate((colors, np.zeros((len(colors), 1), np.uint8)), axis=1)
+            packed = packRGB(rgba)
+            self.lut[packed[::-1]] = np.arange(len(colors), 0, -1) # first of any duplicates wins
+
+    def settings(self):
+        # Describes the encoding, for cache keys
+        return 'palette={} compressLevel={} optimize={}'.format(
+                None if self.palette is None else [list(color) for color in self.palette],
+                self.compressLevel, self.optimize)
+
+    def nearest(self, packed):
+        # Fill in the table for colors not seen before
+        rgb = np.array(unpackRGB(packed), dtype=np.int32)
+        distance = ((rgb[:, None, :] - self.colors[None, :, :]) ** 2).sum(axis=2)
+        self.lut[packed] = distance.argmin(axis=1) + 1
+
+    def quantize(self, image):
+        # RGBA image -> P image on the fixed palette
+        pixels = np.ascontiguousarray(np.asarray(image)).view('<u4')[:, :, 0]
+        clear = pixels < 0x01000000 # alpha 0
+        packed = pixels & 0x00FFFFFF
+        indices = self.lut[packed]
+        unknown = indices == 0
+        unknown &= ~clear
+        if unknown.any():
+            self.nearest(np.unique(packed[unknown]))
+            indices = self.lut[packed]
+        indices[clear] = 0
+        quantized = Image.fromarray(indices, mode='L').convert('P')
+        quantized.putpalette(self.pngPalette)
+        return quantized
+
+    def encode(self, image, metadata=None):
+        # png bytes of an RGBA tile, with the metadata text chunk if given
+        if self.palette is None:
+            quantized = image.convert('P')
+            options = {}
+        else:
+            quantized = self.quantize(image)
+            options = {'transparency': 0}
+        if metadata is not None:
+            metainfo = PngInfo()
+            metainfo.add_text("meta", metadata)
+            options['pnginfo'] = metainfo
+        buffer = io.BytesIO()
+        quantized.save(buffer, format='PNG', compress_level=self.compressLevel,
+                       optimize=self.optimize, **options)
+        return buffer.getvalue()
+
+def buildPalette(fns, maxColors=255, sample=2000):
+    # The maxColors most common opaque colors in up to sample tiles of each panel
+    counts = collections.Counter()
+    for fn in fns:
+        with sqlite3.connect(fn) as conn:
+            for (png,) in conn.execute('SELECT tile_data FROM tiles ORDER BY RANDOM() LIMIT ?;',
+                                       (sample,)):
+                array = np.asarray(Image.open(io.BytesIO(png)).convert('RGBA'))
+                packed = packRGB(array[array[:, :, 3] > 0])
+                (values, n) = np.unique(packed, return_counts=True)
+                counts.update(dict(zip(values.tolist(), n.tolist())))
+    return unpackRGB([c for (c, n) in counts.most_common(maxColors)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a fixed palette from the panels')
+    parser.add_argument('mbtiles', nargs='+', help='Panels to sample')
+    parser.add_argument('--palette', default='rncPalette.json', help='where to write the palette')
+    parser.add_argument('--colors', type=int, default=255, help='Number of colors')
+    parser.add_argument('--sample', type=int, default=2000, help='Tiles sampled from each panel')
+    args = parser.parse_args()
+
+    palette = buildPalette(args.mbtiles, min(args.colors, 255), args.sample)
+    savePalette(args.palette, palette)
+    print('Wrote', len(palette), 'colors to', args.palette)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#! /usr/bin/env python3
+#
+# Composite the tiles of mbtilesQuilt.py --pipeline N in N processes
+#
+# Three stages overlap, so reading the panels, decoding and compositing, and
+# encoding and writing all go on at once:
+#
+#   a reader thread walks the panels and queues each tile's blobs
+#   N compositing processes decode, composite and mask each tile into a slot
+#     of one shared memory block of RGBA buffers
+#   the quilting process settles the tiles it can without compositing, as
+#     mbtilesQuilt.quiltTile does, and encodes and writes the composited
+#     tiles straight from their slots
+#
+# Only the blobs and a slot number pass between the processes, never the
+# pixels. The queues are bounded and there are a fixed number of slots, so
+# memory stays flat however many tiles there are. Tiles finish out of order.
+#
+# Needs multiprocessing.shared_memory, Python 3.8 or later.
+#
+
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+import mbtilesQuilt
+import quiltStats
+import tileClassifier
+
+tileSize = 256 # A larger tile is passed back as bytes rather than in its slot
+slotBytes = tileSize * tileSize * 4
+
+
+def readAhead(plan, depth=64):
+    # Iterate plan in a thread, up to depth items ahead of the caller
+    # An exception in plan is raised again in the caller.
+    items = queue.Queue(depth)
+    def reader():
+        try:
+            for item in plan:
+                items.put(item)
+            items.put(None)
+        except Exception as e:
+            items.put(e)
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def compositor(shm, tasks, results, colors, withStats, parent):
+    # A compositing process, until it is sent None or its parent, pid parent, is gone
+    # tasks are (slot, layers, base) as compositeTile takes them, results
+    # ('tile', slot, hasData, size, data, learned), data being the RGBA bytes
+    # of a tile too big for its slot, else None, and learned the uniform
+    # verdicts found decoding the layers, or ('error', slot, traceback).
+    # ('done', stats report) is sent last.
+    import numpy as np
+    mbtilesQuilt.setTransparentColors(colors)
+    classifier = tileClassifier.TileClassifier() # Verdicts are saved by the quilting process
+    stats = quiltStats.QuiltStats([], interval=0) if withStats else quiltStats.noStats
+    while True:
+        try:
+            task = tasks.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent: # The quilt was killed
+                return
+            continue
+        if task is None:
+            break
+        (slot, layers, base) = task
+        try:
+            (image, hasData) = mbtilesQuilt.compositeTile(layers, base, classifier, stats)
+            (size, data) = (None, None)
+            if hasData:
+                size = image.size
+                if image.width * image.height * 4 <= slotBytes:
+                    pixels = np.ndarray((image.height, image.width, 4), np.uint8, shm.buf,
+                                        slot * slotBytes)
+                    pixels[...] = np.asarray(image)
+                    del pixels
+                else:
+                    data = image.tobytes()
+            results.put(('tile', slot, hasData, size, data, classifier.learned))
+            classifier.learned = {}
+        except Exception:
+            results.put(('error', slot, traceback.format_exc()))
+    results.put(('done', stats.report()))
+
+
+class Pipeline(object):
+    # Composites the tiles quiltWorker hands it in nProcesses processes
+    # quilt() and drain() return whether each tile they finished was written,
+    # as quiltTile does. Every tile is finished once drain() returns.
+
+    def __init__(self, args, output, classifier, replace=False, cache=None,
+                 stats=quiltStats.noStats, manifest=None, nProcesses=2):
+        from multiprocessing import shared_memory
+        # Run as a script mbtilesQuilt.py is __main__, this is another copy of it to set up
+        mbtilesQuilt.setTransparentColors(args.colors)
+        mbtilesQuilt.setEncoder(args.palette, args.compressLevel, args.optimize)
+        self.args = args
+        self.output = output
+        self.classifier = classifier
+        self.replace = replace
+        self.cache = cache
+        self.stats = stats
+        self.manifest = manifest
+        nSlots = 2 * nProcesses # One being composited and one waiting per process
+        self.shm = shared_memory.SharedMemory(create=True, size=nSlots * slotBytes)
+        self.free = list(range(nSlots))
+        self.jobs = {} # slot -> TileJob composited in it
+        self.tasks = multiprocessing.Queue(nSlots)
+        self.results = multiprocessing.Queue()
+        self.processes = [multiprocessing.Process(
+                target=compositor, daemon=True,
+                args=(self.shm, self.tasks, self.results, args.colors, bool(args.stats), os.getpid()))
+                          for i in range(nProcesses)]
+        for process in self.processes:
+            process.start()
+
+    def receive(self, block=True):
+        # The next result, or None if not block and there is none yet
+        while True:
+            try:
+                return self.results.get(timeout=1) if block else self.results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    return None
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError('A compositing process died')
+
+    def finish(self, result):
+        # Encode and write a composited tile from its slot
+        if result[0] == 'error':
+            (tag, slot, text) = result
+            raise RuntimeError('Compositing {} failed\n{}'.format(self.jobs[slot].key, text))
+        (tag, slot, hasData, size, data, learned) = result
+        job = self.jobs.pop(slot)
+        self.classifier.merge(learned)
+        (image, pixels) = (None, None)
+        try:
+            if hasData:
+                from PIL import Image
+                if data is None:
+                    pixels = self.shm.buf[slot * slotBytes:slot * slotBytes + size[0] * size[1] * 4]
+                    image = Image.frombuffer('RGBA', size, pixels, 'raw', 'RGBA', 0, 1)
+                else:
+                    image = Image.frombytes('RGBA', size, data)
+            written = mbtilesQuilt.saveTile(self.args, job, image, self.output, self.replace,
+                                            self.cache, self.stats, self.manifest)
+        except BaseException as e: # The frames saving ran through hold the image, and so the slot
+            traceback.clear_frames(e.__traceback__)
+            raise
+        finally: # Released even if saving failed, or close() cannot free the shared memory
+            del image
+            if pixels is not None:
+                pixels.release()
+        self.free.append(slot)
+        return written
+
+    def quilt(self, key, layers):
+        # Settle a tile, or send it to be composited, and finish the tiles composited meanwhile
+        (written, job) = mbtilesQuilt.prepareTile(self.args, key, layers, self.output,
+                                                  self.classifier, self.replace, self.cache,
+                                                  self.stats, self.manifest)
+        if job is None:
+            return [written]
+        finished = []
+        while not self.free: # Every slot is taken, wait for one
+            finished.append(self.finish(self.receive()))
+        slot = self.free.pop()
+        self.jobs[slot] = job
+        layers = [png.obj if isinstance(png, memoryview) else png # The blob, memoryviews do not pickle
+                  for png in job.pngs]
+        self.tasks.put((slot, layers, job.base))
+        result = self.receive(False)
+        while result is not None:
+            finished.append(self.finish(result))
+            result = self.receive(False)
+        return finished
+
+    def drain(self):
+        # Finish every tile being composited
+        finished = []
+        while self.jobs:
+            finished.append(self.finish(self.receive()))
+        return finished
+
+    def close(self):
+        # Stop the compositing processes, adding their stage times to stats
+        if self.jobs: # Given up on, after an error
+            for process in self.processes:
+                process.terminate()
+        else:
+            for process in self.processes:
+                self.tasks.put(None)
+            nDone = 0
+            while nDone < len(self.processes):
+                result = self.receive()
+                if result[0] == 'done':
+                    self.stats.merge(result[1])
+                    nDone += 1
+        for process in self.processes:
+            process.join()
+        try:
+            self.shm.close()
+        finally:
+            self.shm.unlink()
@@ -0,0 +1,182 @@
+#! /usr/bin/env python3
+#
+# Where mbtilesQuilt.py --stats spends its time
+#
+# Each worker times its stages, reading the panels, decoding, compositing,
+# masking, encoding and writing, counts what happened to each tile, and
+# tracks how fast each panel's tiles were read. The workers' reports are
+# combined into one JSON report with the wall clock time and peak RSS.
+#
+
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError: # Not on Windows
+    resource = None
+
+stages = ['read', 'outputRead', 'decode', 'composite', 'mask', 'encode', 'write']
+
+
+def peakRSS():
+    # Peak resident set size of this process in bytes
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+class Stage(object):
+    # Adds the time spent in a with block to a stage
+
+    def __init__(self, seconds, name, lock):
+        self.seconds = seconds
+        self.name = name
+        self.lock = lock
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+        with self.lock:
+            self.seconds[self.name] += seconds
+        return False
+
+
+class QuiltStats(object):
+    # Stage times, tile counters and per panel read rates of one worker
+    # A progress line is printed every interval seconds, never if interval is 0.
+    # The totals are updated under a lock, as quiltPipeline.py's reader thread
+    # counts the panel reads while the worker times the other stages.
+
+    def __init__(self, panels, worker=0, interval=30):
+        self.panels = panels
+        self.worker = worker
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.seconds = dict.fromkeys(stages, 0.0)
+        self.stages = {name: Stage(self.seconds, name, self.lock) for name in stages}
+        self.counters = {}
+        self.panelTiles = [0] * len(panels)
+        self.panelBytes = [0] * len(panels)
+        self.panelSeconds = [0.0] * len(panels)
+        self.t0 = time.perf_counter()
+        self.nextProgress = self.t0 + interval
+
+    def stage(self, name):
+        return self.stages[name]
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def panelRead(self, index, nBytes, seconds):
+        # One tile read from panel index
+        with self.lock:
+            self.panelTiles[index] += 1
+            self.panelBytes[index] += nBytes
+            self.panelSeconds[index] += seconds
+            self.seconds['read'] += seconds
+
+    def merge(self, report):
+        # Add the stage times and counters of another process's report, as
+        # quiltPipeline.py's compositors time decoding for their worker
+        with self.lock:
+            for (name, seconds) in report['stages'].items():
+                self.seconds[name] += seconds
+            for (name, n) in report['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def progress(self):
+        # Print a progress line if it is time to
+        if not self.interval:
+            return
+        now = time.perf_counter()
+        if now < self.nextProgress:
+            return
+        self.nextProgress = now + self.interval
+        elapsed = now - self.t0
+        nTiles = self.counters.get('tiles', 0)
+        rss = peakRSS()
+        print('Worker {}: {} tiles in {:.0f}s, {:.1f} tiles/s, peak RSS {}'.format(
+            self.worker, nTiles, elapsed, nTiles / elapsed if elapsed else 0.0,
+            '{:.0f}MB'.format(rss / 1048576) if rss is not None else 'unknown'), flush=True)
+
+    def report(self):
+        # A JSON friendly summary of this worker
+        with self.lock:
+            return {'worker': self.worker,
+                    'elapsed': time.perf_counter() - self.t0,
+                    'stages': dict(self.seconds),
+                    'counters': dict(self.counters),
+                    'panels': {panel: {'tiles': self.panelTiles[index],
+                                       'bytes': self.panelBytes[index],
+                                       'readSeconds': self.panelSeconds[index]}
+                               for (index, panel) in enumerate(self.panels)},
+                    'peakRSS': peakRSS()}
+
+
+class NoStats(object):
+    # Stands in for QuiltStats when --stats is not given
+
+    class NoStage(object):
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *exc):
+            return False
+
+    noStage = NoStage()
+
+    def stage(self, name):
+        return self.noStage
+
+    def count(self, name, n=1):
+        pass
+
+    def panelRead(self, index, nBytes, seconds):
+        pass
+
+    def merge(self, report):
+        pass
+
+    def progress(self):
+        pass
+
+    def report(self):
+        return None
+
+
+noStats = NoStats()
+
+
+def combine(reports, elapsed):
+    # One report from the workers' reports, elapsed is the wall clock time
+    # Stage seconds are summed over the workers, so they can exceed elapsed.
+    combined = {'elapsed': elapsed,
+                'workers': len(reports),
+                'stages': dict.fromkeys(stages, 0.0),
+                'counters': {},
+                'panels': {}}
+    for report in reports:
+        for (name, seconds) in report['stages'].items():
+            combined['stages'][name] += seconds
+        for (name, n) in report['counters'].items():
+            combined['counters'][name] = combined['counters'].get(name, 0) + n
+        for (panel, counts) in report['panels'].items():
+            total = combined['panels'].setdefault(panel, {'tiles': 0, 'bytes': 0, 'readSeconds': 0.0})
+            for (name, value) in counts.items():
+                total[name] += value
+    for counts in combined['panels'].values():
+        counts['tilesPerSecond'] = (counts['tiles'] / counts['readSeconds']
+                                    if counts['readSeconds'] else None)
+    nTiles = combined['counters'].get('tiles', 0)
+    combined['tilesPerSecond'] = nTiles / elapsed if elapsed else None
+    rss = [report['peakRSS'] for report in reports + [{'peakRSS': peakRSS()}]
+           if report['peakRSS'] is not None]
+    combined['peakRSS'] = max(rss) if rss else None # of any one process
+    combined['workerReports'] = reports
+    return combined
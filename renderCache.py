@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+#
+# Persistent cache of quilted tiles across runs
+#
+# A tile's key is a hash of the processing settings and of every source blob
+# that went into it, in compositing order, so a tile whose sources have not
+# changed since the last run is copied, or hard linked, from the cache
+# instead of being decoded, composited and encoded again.
+#
+# The encoded tiles are kept as cachedir/ab/abcdef...png, and an SQLite index
+# holds their sizes and when they were last used for least recently used
+# eviction. Tiles with no data are cached in the index only.
+#
+
+import hashlib
+import os
+import os.path
+import sqlite3
+import time
+
+
+def layerDigest(layer):
+    # A layer is png bytes, or (width, height, rgba) for a uniform tile
+    if isinstance(layer, tuple):
+        return repr(layer).encode()
+    return hashlib.sha1(layer).digest()
+
+
+class RenderCache(object):
+    # Encoded tiles keyed by the hash of their sources and the settings
+    # Index updates are batched, batchSize per transaction.
+
+    def __init__(self, cachedir, maxBytes, batchSize=1000):
+        self.cachedir = cachedir
+        self.maxBytes = maxBytes
+        self.batchSize = batchSize
+        self.hits = 0
+        self.misses = 0
+        self.pending = {} # key -> size, entries to add or touch
+        os.makedirs(cachedir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cachedir, 'index.db'), timeout=600)
+        with self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL;')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tiles'
+                              ' (key TEXT PRIMARY KEY, size INTEGER, used REAL) WITHOUT ROWID;')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tiles_used ON tiles (used);')
+
+    @staticmethod
+    def key(settings, layers, base=None, metadata=None):
+        # settings is a string describing how tiles are processed
+        digest = hashlib.sha1(settings.encode())
+        if base is not None: # the existing tile merged into
+            digest.update(b'base' + layerDigest(base))
+        for layer in layers:
+            digest.update(b'layer' + layerDigest(layer))
+        digest.update(b'meta' + repr(metadata).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cachedir, key[:2], key + '.png')
+
+    def get(self, key):
+        # returns (found, path), path is None for a cached tile with no data
+        if key in self.pending:
+            size = self.pending[key]
+        else:
+            result = self.conn.execute('SELECT size FROM tiles WHERE key=?;', (key,)).fetchone()
+            size = result[0] if result else None
+        if size is None:
+            self.misses += 1
+            return (False, None)
+        path = self.path(key) if size else None
+        if path is not None and not os.path.exists(path): # evicted by another process
+            self.misses += 1
+            return (False, None)
+        self.hits += 1
+        self.touch(key, size)
+        return (True, path)
+
+    def put(self, key, png):
+        # png is None for a tile with no data
+        if png:
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as fp:
+                fp.write(png)
+            os.replace(tmp, path)
+        self.touch(key, len(png) if png else 0)
+
+    def touch(self, key, size):
+        self.pending[key] = size
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO tiles VALUES (?,?,?);',
+                                  [(key, size, now) for (key, size) in self.pending.items()])
+        self.pending = {}
+
+    def evict(self):
+        # Remove least recently used tiles until the cache fits in maxBytes
+        # returns (number of tiles removed, bytes in the cache)
+        self.flush()
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM tiles;').fetchone()[0]
+        removed = []
+        if total > self.maxBytes:
+            for (key, size) in self.conn.execute('SELECT key, size FROM tiles ORDER BY used;'):
+                if total <= self.maxBytes:
+                    break
+                removed.append(key)
+                total -= size
+            for key in removed:
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+            with self.conn:
+                self.conn.executemany('DELETE FROM tiles WHERE key=?;', [(key,) for key in removed])
+        return (len(removed), total)
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        return 100.0 * self.hits / lookups if lookups else 0.0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+#
+# Recognize uniform, single color, tiles from their PNG bytes without decoding them
+#
+# A tile is uniform if it is one palette entry, or if an identical blob was
+# decoded before and found to be one color. Verdicts are kept by blob hash in
+# a small SQLite file so they carry over between panels and runs.
+#
+
+import hashlib
+import os
+import sqlite3
+import struct
+
+pngSignature = b'\x89PNG\r\n\x1a\n'
+
+# Uniform 256x256 tiles compress to a few hundred bytes, anything larger
+# is assumed to have detail and is not hashed.
+maxUniformSize = 4096
+
+
+def pngHeader(png):
+    # Walk the chunks ahead of the image data
+    # returns (width, height, colorType, palette, transparency) or None
+    if png[:8] != pngSignature:
+        return None
+    width = height = colorType = None
+    palette = transparency = None
+    pos = 8
+    while pos + 8 <= len(png):
+        (length, kind) = struct.unpack('>I4s', png[pos:pos+8])
+        data = png[pos+8:pos+8+length]
+        if kind == b'IHDR':
+            (width, height, bitDepth, colorType) = struct.unpack('>IIBB', data[:10])
+        elif kind == b'PLTE':
+            palette = data
+        elif kind == b'tRNS':
+            transparency = data
+        elif kind == b'IDAT':
+            break
+        pos += 12 + length
+    if width is None:
+        return None
+    return (width, height, colorType, palette, transparency)
+
+
+def paletteColor(png):
+    # A palette image with a single entry can only be that color
+    # returns (width, height, (r, g, b, a)) or None
+    header = pngHeader(png)
+    if header is None:
+        return None
+    (width, height, colorType, palette, transparency) = header
+    if colorType != 3 or palette is None or len(palette) != 3:
+        return None
+    alpha = transparency[0] if transparency else 255
+    return (width, height, (palette[0], palette[1], palette[2], alpha))
+
+
+def defaultCache(indir):
+    # indir/uniformTiles.db, or None if indir is read only and the panels must be left untouched
+    # Without a file the verdicts are only kept for the run.
+    if not os.access(indir, os.W_OK):
+        return None
+    return os.path.join(indir, 'uniformTiles.db')
+
+
+class TileClassifier(object):
+    # Verdicts on whether tile blobs are a single color, keyed by blob hash
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.uniform = {} # hash -> (width, height, (r, g, b, a))
+        self.learned = {} # verdicts not yet saved to fn
+        self.hits = 0
+        if fn:
+            with sqlite3.connect(fn, timeout=60) as conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS uniform'
+                             ' (hash BLOB PRIMARY KEY, width INTEGER, height INTEGER,'
+                             ' r INTEGER, g INTEGER, b INTEGER, a INTEGER);')
+                for (key, width, height, r, g, b, a) in conn.execute('SELECT * FROM uniform;'):
+                    self.uniform[bytes(key)] = (width, height, (r, g, b, a))
+
+    @staticmethod
+    def blobHash(png):
+        return hashlib.sha1(png).digest()
+
+    def classify(self, png):
+        # returns (width, height, (r, g, b, a)) if png is known to be one color, else None
+        if len(png) > maxUniformSize:
+            return None
+        verdict = paletteColor(png)
+        if verdict is None:
+            verdict = self.uniform.get(self.blobHash(png))
+        if verdict is not None:
+            self.hits += 1
+        return verdict
+
+    def learn(self, png, image):
+        # Record the verdict for a blob that had to be decoded
+        # image is png decoded to RGBA
+        if len(png) > maxUniformSize:
+            return
+        extrema = image.getextrema()
+        if any(lo != hi for (lo, hi) in extrema):
+            return
+        verdict = (image.width, image.height, tuple(lo for (lo, hi) in extrema))
+        key = self.blobHash(png)
+        self.uniform[key] = verdict
+        self.learned[key] = verdict
+
+    def merge(self, verdicts):
+        # Take the verdicts another classifier learned, as quiltPipeline.py's compositors do
+        self.uniform.update(verdicts)
+        self.learned.update(verdicts)
+
+    def save(self):
+        # Add newly learned verdicts to the cache file
+        if not self.fn or not self.learned:
+            return
+        with sqlite3.connect(self.fn, timeout=60) as conn:
+            conn.executemany('INSERT OR IGNORE INTO uniform VALUES (?,?,?,?,?,?,?);',
+                             [(key, width, height) + tuple(rgba)
+                              for (key, (width, height, rgba)) in self.learned.items()])
+        self.learned = {}
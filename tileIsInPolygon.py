@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 import sys, os
+import bisect
 import json
+import numpy as np
 import shapely
-from shapely.geometry import Polygon, Point, mapping, shape
+from shapely.geometry import Polygon, MultiPolygon, Point, mapping, shape
+from shapely.ops import unary_union
 
 from globalmaptiles import GlobalMercator
 
@@ -14,6 +17,138 @@ def tileIsInPolygon (x, y, zoom, poly: Polygon):
     return poly.contains(Point(center))
 
 
+# Coverage of a polygon, all the tiles tileIsInPolygon would accept, found by
+# scanline rasterization in tile space rather than one shapely call per tile.
+#
+# For each tile row a horizontal line through the row's center latitude is
+# crossed with every polygon edge, and the tiles whose center longitude lies
+# between a pair of crossings are inside (even-odd rule, so holes work).
+# The result is compact, one (ty, txStart, txEnd) span per run of tiles, TMS
+# rows, txEnd exclusive.
+
+rowChunk = 4096 # rows crossed with the edges at once
+
+
+def loadPolygon(fn):
+    # Polygon or MultiPolygon from a GeoJSON file, a FeatureCollection is unioned
+    with open(fn, 'r') as fp:
+        geojson = json.load(fp)
+    if geojson.get('type') == 'FeatureCollection':
+        return unary_union([shape(feature['geometry']) for feature in geojson['features']])
+    if geojson.get('type') == 'Feature':
+        return shape(geojson['geometry'])
+    return shape(geojson)
+
+
+def polygonEdges(poly):
+    # (x1, y1, x2, y2) arrays of every ring edge, in lon/lat
+    if isinstance(poly, MultiPolygon):
+        poly = unary_union(poly) # overlapping parts would cancel under even-odd
+    polys = poly.geoms if isinstance(poly, MultiPolygon) else [poly]
+    edges = []
+    for part in polys:
+        for ring in [part.exterior] + list(part.interiors):
+            xy = np.asarray(ring.coords, dtype=np.float64)[:, :2]
+            edges.append(np.hstack((xy[:-1], xy[1:])))
+    edges = np.vstack(edges)
+    edges = edges[edges[:, 1] != edges[:, 3]] # horizontal edges never cross a row
+    return (edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3])
+
+
+def tileRange(minLat, minLon, maxLat, maxLon, zoom):
+    # TMS tile columns and rows covering a lat/lon box, clipped to the zoom level
+    n = 2 ** zoom
+    mx, my = mercator.LatLonToMetersArray([minLat, maxLat], [minLon, maxLon])
+    tx, ty = mercator.MetersToTileArray(mx, my, zoom)
+    txMin, txMax = max(0, int(tx[0]) - 1), min(n - 1, int(tx[1]) + 1)
+    tyMin, tyMax = max(0, int(ty[0]) - 1), min(n - 1, int(ty[1]) + 1)
+    return (txMin, txMax, tyMin, tyMax)
+
+
+def coveredSpans(poly, zoom):
+    # int64 array of (ty, txStart, txEnd) spans of the tiles at zoom whose
+    # center is inside poly
+    (minLon, minLat, maxLon, maxLat) = poly.bounds
+    (txMin, txMax, tyMin, tyMax) = tileRange(max(minLat, -85.05112878), minLon,
+                                             min(maxLat, 85.05112878), maxLon, zoom)
+    (x1, y1, x2, y2) = polygonEdges(poly)
+    slope = (x2 - x1) / (y2 - y1)
+
+    # Tile center longitudes are increasing in tx
+    columns = np.arange(txMin, txMax + 1, dtype=np.int64)
+    (a, lon0, b, lon1) = mercator.TileLatLonBoundsArray(columns, 0, zoom)
+    centerLon = (lon0 + lon1) / 2
+
+    spans = []
+    for start in range(tyMin, tyMax + 1, rowChunk):
+        rows = np.arange(start, min(start + rowChunk, tyMax + 1), dtype=np.int64)
+        (lat0, a, lat1, b) = mercator.TileLatLonBoundsArray(0, rows, zoom)
+        centerLat = ((lat0 + lat1) / 2)[:, None]
+        crosses = (y1 > centerLat) != (y2 > centerLat)
+        xs = np.where(crosses, x1 + (centerLat - y1) * slope, np.inf)
+        xs.sort(axis=1) # crossings first, padding at the end
+        if xs.shape[1] % 2:
+            xs = np.hstack((xs, np.full((xs.shape[0], 1), np.inf)))
+        # Pairs of crossings bound the inside, strictly, as poly.contains does
+        txStart = np.searchsorted(centerLon, xs[:, 0::2], side='right')
+        txEnd = np.searchsorted(centerLon, xs[:, 1::2], side='left')
+        keep = txEnd > txStart
+        rowIndex = np.broadcast_to(rows[:, None], keep.shape)[keep]
+        spans.append(np.column_stack((rowIndex, txMin + txStart[keep], txMin + txEnd[keep])))
+    if not spans:
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.vstack(spans).astype(np.int64)
+
+
+def tilesInPolygon(poly, minZoom, maxZoom):
+    # {zoom: spans} for every zoom in minZoom..maxZoom
+    return {zoom: coveredSpans(poly, zoom) for zoom in range(minZoom, maxZoom + 1)}
+
+
+def spanCount(spans):
+    return int((spans[:, 2] - spans[:, 1]).sum())
+
+
+def spanTiles(spans):
+    # Expand spans into (tx, ty) arrays
+    lengths = spans[:, 2] - spans[:, 1]
+    ty = np.repeat(spans[:, 0], lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    tx = np.repeat(spans[:, 1], lengths) + offsets
+    return (tx, ty)
+
+
+class TileRegion(object):
+    # The tiles covered by a polygon, zoom by zoom as they are asked for
+
+    def __init__(self, poly):
+        self.poly = poly
+        self.cache = {} # zoom -> (spans, span start keys, span end keys)
+
+    def spans(self, zoom):
+        if zoom not in self.cache:
+            spans = coveredSpans(self.poly, zoom)
+            n = 2 ** zoom # Spans are sorted by row then column, so row * n + column is too
+            self.cache[zoom] = (spans,
+                                (spans[:, 0] * n + spans[:, 1]).tolist(),
+                                (spans[:, 0] * n + spans[:, 2]).tolist())
+        return self.cache[zoom][0]
+
+    def bounds(self, zoom):
+        # (txMin, txMax, tyMin, tyMax) of the covered tiles, inclusive, or None
+        spans = self.spans(zoom)
+        if len(spans) == 0:
+            return None
+        return (int(spans[:, 1].min()), int(spans[:, 2].max()) - 1,
+                int(spans[:, 0].min()), int(spans[:, 0].max()))
+
+    def contains(self, zoom, tx, ty):
+        self.spans(zoom)
+        (spans, starts, ends) = self.cache[zoom]
+        key = ty * 2 ** zoom + tx
+        i = bisect.bisect_right(starts, key) - 1
+        return i >= 0 and key < ends[i]
+
 
 if __name__ == "__main__":
 
@@ -58,3 +193,13 @@ if __name__ == "__main__":
     polyjson = json.loads(polyT)
     poly = Polygon(polyjson["features"][0]["geometry"]["coordinates"][0])
     print (tileIsInPolygon(164, 666, 10, poly))
+
+    # Whole coverage, and a check against tileIsInPolygon at a low zoom
+    for (zoom, spans) in tilesInPolygon(poly, 8, 18).items():
+        print (zoom, len(spans), 'spans', spanCount(spans), 'tiles')
+    (tx, ty) = spanTiles(coveredSpans(poly, 12))
+    covered = set(zip(tx.tolist(), ty.tolist()))
+    (txMin, txMax, tyMin, tyMax) = tileRange(47.0, -123.5, 49.2, -121.1, 12)
+    for x in range(txMin, txMax + 1):
+        for y in range(tyMin, tyMax + 1):
+            assert tileIsInPolygon(x, y, 12, poly) == ((x, y) in covered)
@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+#
+# Record of how each quilted tile was made, so unchanged tiles are not rewritten
+#
+# For every tile the hash of its sources, keyed as renderCache.py keys them,
+# and the hash of the PNG written are kept in an SQLite file. A tile whose
+# sources and current PNG both match what was recorded is skipped before it
+# is decoded, and one that is recomposited into the bytes already there is
+# not written again, so file times, webserver caches and rsync are left alone.
+#
+# Each quilt is a run, and tiles written or removed are stamped with it, so
+# the tiles changed by the last run can be listed for rsync --files-from.
+#
+# ./tileManifest.py manifest.db                    tiles changed by the last run
+# ./tileManifest.py manifest.db --list changed.txt their paths in the tree
+#
+
+import argparse
+import hashlib
+import os.path
+import sqlite3
+import time
+
+import renderCache
+import tileOutput
+
+
+def outputDigest(png):
+    return hashlib.sha1(png).hexdigest() if png is not None else None
+
+
+class TileManifest(object):
+    # (source hash, output hash, run) of every tile quilted with the manifest
+    # Updates are batched, batchSize per transaction.
+    # resumed is True when carrying on a run that was killed, whose unflushed
+    # records are lost though its tiles were written.
+
+    def __init__(self, fn, run=None, batchSize=1000, resumed=False):
+        self.fn = fn
+        self.run = run
+        self.resumed = resumed
+        self.batchSize = batchSize
+        self.pending = {} # (zoom, column, row) -> (source, output, run)
+        self.conn = sqlite3.connect(fn, timeout=600)
+        with self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL;') # one connection per worker
+            self.conn.execute('CREATE TABLE IF NOT EXISTS tiles'
+                              ' (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,'
+                              ' source TEXT, output TEXT, run INTEGER,'
+                              ' PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID;')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS tiles_run ON tiles (run);')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS runs'
+                              ' (run INTEGER PRIMARY KEY, started REAL, settings TEXT);')
+
+    def startRun(self, settings):
+        # A new run, returns its number
+        with self.conn:
+            self.run = self.conn.execute('INSERT INTO runs (started, settings) VALUES (?,?);',
+                                         (time.time(), settings)).lastrowid
+        return self.run
+
+    def lastRun(self):
+        return self.conn.execute('SELECT MAX(run) FROM runs;').fetchone()[0]
+
+    @staticmethod
+    def key(settings, layers, metadata=None):
+        # Hash of everything a tile is made from
+        return renderCache.RenderCache.key(settings, layers, None, metadata)
+
+    def get(self, key):
+        # (source, output, run) recorded for a tile, or None
+        if key in self.pending:
+            return self.pending[key]
+        result = self.conn.execute('SELECT source, output, run FROM tiles'
+                                   ' WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
+                                   key).fetchone()
+        return tuple(result) if result else None
+
+    def unchanged(self, key, source, current):
+        # True if the tile was made from source and current, the png in the output, is what was written
+        recorded = self.get(key)
+        return (recorded is not None and current is not None and
+                recorded[0] == source and recorded[1] == outputDigest(current))
+
+    def record(self, key, source, png, changed=True):
+        # png is None for a tile removed from the output
+        # A tile that did not change keeps the run it last changed in, if any,
+        # unless it no longer holds the png recorded, or holds one never
+        # recorded while resuming, written by the run before it was killed
+        run = self.run
+        if not changed:
+            recorded = self.get(key)
+            if recorded is None:
+                run = self.run if self.resumed else None
+            elif recorded[1] == outputDigest(png):
+                run = recorded[2]
+        self.pending[key] = (source, outputDigest(png), run)
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?);',
+                                  [key + value for (key, value) in self.pending.items()])
+        self.pending = {}
+
+    def changed(self, run):
+        # (written, removed) lists of the (zoom, column, row) changed in run
+        self.flush()
+        written = []
+        removed = []
+        for (zoom, column, row, output) in self.conn.execute(
+                'SELECT zoom_level, tile_column, tile_row, output FROM tiles WHERE run=?'
+                ' ORDER BY zoom_level, tile_column, tile_row;', (run,)):
+            (written if output is not None else removed).append((zoom, column, row))
+        return (written, removed)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def writeList(fn, keys, tree=None):
+    # One changed tile per line, its path relative to the tree, else zoom/column/row TMS
+    with open(fn, 'w') as fp:
+        for key in keys:
+            if tree is not None:
+                fp.write(os.path.relpath(tree.path(*key)[1], tree.outdir) + '\n')
+            else:
+                fp.write('{}/{}/{}\n'.format(*key))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the tiles changed by a quilt')
+    parser.add_argument('manifest', help='Manifest written by mbtilesQuilt.py --manifest')
+    parser.add_argument('--run', type=int, help='Run to report on, default the last')
+    parser.add_argument('--list', help='Write the paths of the tiles written in the run to this file')
+    parser.add_argument('--outdir', help='Tree the paths are relative to, default zoom/column/row TMS')
+    parser.add_argument('--flip_y', default=True, help='Flip Y axis for non-TMS servers')
+    args = parser.parse_args()
+
+    manifest = TileManifest(args.manifest)
+    run = args.run if args.run is not None else manifest.lastRun()
+    (written, removed) = manifest.changed(run)
+    manifest.close()
+    print('Run', run, 'wrote', len(written), 'tiles and removed', len(removed))
+    if args.list:
+        tree = None
+        if args.outdir:
+            tree = tileOutput.TileTree(args.outdir, args.flip_y)
+        writeList(args.list, written, tree)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+#! /usr/bin/env python3
+#
+# Where mbtilesQuilt.py puts the quilted tiles
+#
+# TileTree is the Z{zoom}/{row}/{column}.png directory tree served to SFMC.
+# TileArchive is a single MBTiles file, each distinct image is stored once in
+# an images table and referenced from a map table, with a tiles view so it
+# reads like any other MBTiles file.
+#
+# Both take TMS rows, TileTree flips them for non-TMS servers.
+#
+# A TileTree can keep each distinct image once in a TileStore, a directory of
+# PNGs named by their hash, with the tiles of the tree hard links into it.
+# The store must be on the same filesystem as the tree.
+#
+# ./tileOutput.py quilt.mbtiles RNC_ROOT exports an archive as a tree.
+#
+
+import argparse
+import errno
+import hashlib
+import os
+import os.path
+import sqlite3
+
+
+def tmpName(fn):
+    return '{}.{}.tmp'.format(fn, os.getpid())
+
+
+class TileStore(object):
+    # Distinct tile images as storedir/ab/abcdef...png, named by their sha1
+    # A stored image's link count, less its own entry, is the number of tiles using it.
+
+    def __init__(self, storedir):
+        self.storedir = storedir
+        self.dirs = set() # directories known to exist
+
+    def path(self, png):
+        digest = hashlib.sha1(png).hexdigest()
+        return os.path.join(self.storedir, digest[:2], digest + '.png')
+
+    def put(self, png, fresh=False):
+        # Path of the stored image, written if it is new, or rewritten as a
+        # fresh file if fresh, when the old one has as many links as it can take
+        path = self.path(png)
+        if fresh or not os.path.exists(path):
+            odir = os.path.dirname(path)
+            if odir not in self.dirs:
+                os.makedirs(odir, exist_ok=True)
+                self.dirs.add(odir)
+            tmp = tmpName(path)
+            with open(tmp, 'wb') as fp:
+                fp.write(png)
+            os.replace(tmp, path)
+        return path
+
+    def images(self):
+        # Walk (path, links from tiles, size) over the stored images
+        if not os.path.isdir(self.storedir):
+            return
+        for sub in os.scandir(self.storedir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.png'):
+                    st = entry.stat()
+                    yield (entry.path, st.st_nlink - 1, st.st_size)
+
+    def removeOrphans(self):
+        # Remove the images no tile links to any more, returns how many
+        count = 0
+        for (path, links, size) in self.images():
+            if links == 0:
+                os.remove(path)
+                count += 1
+        return count
+
+    def counts(self):
+        # (distinct images, tiles linking to them, bytes stored, bytes the links save)
+        (nImages, nTiles, nBytes, nSaved) = (0, 0, 0, 0)
+        for (path, links, size) in self.images():
+            nImages += 1
+            nTiles += links
+            nBytes += size
+            nSaved += max(0, links - 1) * size
+        return (nImages, nTiles, nBytes, nSaved)
+
+
+class TileTree(object):
+    # Quilted tiles as outdir/Z{zoom}/{row}/{column}.png
+    # With storedir, each tile is a hard link to its image in a TileStore
+
+    def __init__(self, outdir, flip_y=True, storedir=None):
+        self.outdir = outdir
+        self.flip_y = flip_y
+        self.store = TileStore(storedir) if storedir else None
+        self.dirs = set() # directories known to exist
+
+    def path(self, zoom, column, row):
+        # Output directory and filename of a tile
+        # jayb Y is inverted in TMS (default format for MBTiles)
+        if self.flip_y:
+            row = (2 ** zoom) - (1 + row)
+        odir = os.path.join(self.outdir, 'Z' + str(zoom), str(row)).replace("\\","/")
+        ofn = os.path.join(odir, '{}.png'.format(column)).replace("\\","/")
+        return (odir, ofn)
+
+    def read(self, zoom, column, row):
+        # png bytes of an existing tile, or None
+        (odir, ofn) = self.path(zoom, column, row)
+        try:
+            with open(ofn, 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, zoom, column, row, png):
+        # Written beside the tile and renamed over it, so a reader, or a hard
+        # link into a cache or another version, never sees a partial tile
+        if self.store is not None:
+            self.storeLink(zoom, column, row, png)
+            return
+        (odir, ofn) = self.path(zoom, column, row)
+        self.makedirs(odir)
+        tmp = tmpName(ofn)
+        with open(tmp, 'wb') as fp:
+            fp.write(png)
+        os.replace(tmp, ofn)
+
+    def link(self, zoom, column, row, src):
+        # Hard link an already encoded tile into place, copying it if src is on another device
+        if self.store is not None: # Linked to the store's copy instead
+            with open(src, 'rb') as fp:
+                self.storeLink(zoom, column, row, fp.read())
+            return
+        (odir, ofn) = self.path(zoom, column, row)
+        if self.linked(src, ofn):
+            return
+        self.makedirs(odir)
+        tmp = tmpName(ofn)
+        self.unlink(tmp)
+        try:
+            os.link(src, tmp)
+        except OSError:
+            with open(src, 'rb') as fp:
+                png = fp.read()
+            with open(tmp, 'wb') as fp:
+                fp.write(png)
+        os.replace(tmp, ofn)
+
+    def storeLink(self, zoom, column, row, png):
+        # Hard link the tile to its image in the store
+        (odir, ofn) = self.path(zoom, column, row)
+        src = self.store.put(png)
+        if self.linked(src, ofn):
+            return
+        self.makedirs(odir)
+        tmp = tmpName(ofn)
+        self.unlink(tmp)
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            os.link(self.store.put(png, True), tmp) # a fresh copy takes the next links
+        os.replace(tmp, ofn)
+
+    def makedirs(self, odir):
+        if odir not in self.dirs:
+            os.makedirs(odir, exist_ok=True)
+            self.dirs.add(odir)
+
+    @staticmethod
+    def linked(src, ofn):
+        # True if ofn is already a link to src, renaming another link to src over it would do nothing
+        try:
+            return os.path.samestat(os.stat(src), os.stat(ofn))
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def unlink(ofn):
+        try:
+            os.remove(ofn)
+        except FileNotFoundError:
+            pass
+
+    def remove(self, zoom, column, row):
+        # returns True if there was a tile to remove
+        (odir, ofn) = self.path(zoom, column, row)
+        try:
+            os.remove(ofn)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def zooms(self):
+        # Zoom levels with a directory, in order
+        if not os.path.isdir(self.outdir):
+            return []
+        return sorted(int(name[1:]) for name in os.listdir(self.outdir)
+                      if name.startswith('Z') and name[1:].isdigit())
+
+    def keys(self, zoom, columns=None, rows=None):
+        # Walk the (column, row) of the tiles at zoom, TMS rows
+        # columns and rows, if given, are [start, end) ranges to walk only
+        zdir = os.path.join(self.outdir, 'Z' + str(zoom))
+        if not os.path.isdir(zdir):
+            return
+        if rows is None:
+            names = [entry.name for entry in os.scandir(zdir) if entry.is_dir() and entry.name.isdigit()]
+        elif self.flip_y:
+            names = [str((2 ** zoom) - (1 + row)) for row in range(*rows)]
+        else:
+            names = [str(row) for row in range(*rows)]
+        for name in names:
+            row = int(name)
+            if self.flip_y:
+                row = (2 ** zoom) - (1 + row)
+            try:
+                entries = os.scandir(os.path.join(zdir, name))
+            except FileNotFoundError: # No tiles in the row
+                continue
+            with entries:
+                for entry in entries:
+                    (column, ext) = os.path.splitext(entry.name)
+                    if ext == '.png' and column.isdigit() and (
+                            columns is None or columns[0] <= int(column) < columns[1]):
+                        yield (int(column), row)
+
+    def close(self):
+        pass
+
+
+class TileArchive(object):
+    # Quilted tiles in one MBTiles file, identical images stored once
+    # Writes are batched, batchSize tiles per transaction.
+
+    def __init__(self, fn, batchSize=1000):
+        self.fn = fn
+        self.batchSize = batchSize
+        self.pending = {} # (zoom, column, row) -> png, or None to remove
+        self.conn = sqlite3.connect(fn, timeout=600, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL;') # workers read while others write
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.execute('BEGIN IMMEDIATE;')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS map'
+                          ' (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,'
+                          ' tile_id TEXT, grid_id TEXT);')
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS map_index'
+                          ' ON map (zoom_level, tile_column, tile_row);')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);')
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);')
+        self.conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);')
+        self.conn.execute('CREATE VIEW IF NOT EXISTS tiles AS'
+                          ' SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,'
+                          ' map.tile_row AS tile_row, images.tile_data AS tile_data'
+                          ' FROM map JOIN images ON images.tile_id = map.tile_id;')
+        self.conn.executemany('INSERT OR IGNORE INTO metadata VALUES (?,?);',
+                              [('name', 'NOAA RNC'), ('type', 'overlay'),
+                               ('version', '1'), ('format', 'png'),
+                               ('description', 'NOAA RNC panels quilted by mbtilesQuilt.py')])
+        self.conn.execute('COMMIT;')
+
+    @staticmethod
+    def tileId(png):
+        return hashlib.sha1(png).hexdigest()
+
+    def read(self, zoom, column, row):
+        key = (zoom, column, row)
+        if key in self.pending:
+            return self.pending[key]
+        result = self.conn.execute('SELECT tile_data FROM tiles'
+                                   ' WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
+                                   key).fetchone()
+        return result[0] if result else None
+
+    def write(self, zoom, column, row, png):
+        self.pending[(zoom, column, row)] = png
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def link(self, zoom, column, row, src):
+        with open(src, 'rb') as fp:
+            self.write(zoom, column, row, fp.read())
+
+    def remove(self, zoom, column, row):
+        existed = self.read(zoom, column, row) is not None
+        self.pending[(zoom, column, row)] = None
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+        return existed
+
+    def flush(self):
+        # Write the pending tiles in one transaction
+        if not self.pending:
+            return
+        images = {}
+        maps = []
+        removes = []
+        for (key, png) in self.pending.items():
+            if png is None:
+                removes.append(key)
+            else:
+                tileId = self.tileId(png)
+                images[tileId] = png
+                maps.append(key + (tileId,))
+        self.conn.execute('BEGIN IMMEDIATE;')
+        self.conn.executemany('INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?,?);',
+                              [(png, tileId) for (tileId, png) in images.items()])
+        self.conn.executemany('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id)'
+                              ' VALUES (?,?,?,?);', maps)
+        self.conn.executemany('DELETE FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
+                              removes)
+        self.conn.execute('COMMIT;')
+        self.pending = {}
+
+    def removeOrphans(self):
+        # Drop images no longer referenced by any tile, after replacements or removals
+        self.flush()
+        with self.conn:
+            self.conn.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map);')
+
+    def counts(self):
+        # (number of tiles, number of distinct images)
+        self.flush()
+        return (self.conn.execute('SELECT COUNT(*) FROM map;').fetchone()[0],
+                self.conn.execute('SELECT COUNT(*) FROM images;').fetchone()[0])
+
+    def zooms(self):
+        self.flush()
+        return [zoom for (zoom,) in self.conn.execute(
+                'SELECT DISTINCT zoom_level FROM map ORDER BY zoom_level;')]
+
+    def keys(self, zoom, columns=None, rows=None):
+        # Walk the (column, row) of the tiles at zoom
+        # columns and rows, if given, are [start, end) ranges to walk only
+        self.flush()
+        sql = 'SELECT tile_column,tile_row FROM map WHERE zoom_level=?'
+        params = [zoom]
+        if columns is not None:
+            sql += ' AND tile_column>=? AND tile_column<?'
+            params += columns
+        if rows is not None:
+            sql += ' AND tile_row>=? AND tile_row<?'
+            params += rows
+        return self.conn.execute(sql + ';', params)
+
+    def tiles(self):
+        # Walk (zoom, column, row, png) over all the tiles
+        self.flush()
+        return self.conn.execute('SELECT zoom_level,tile_column,tile_row,tile_data FROM tiles'
+                                 ' ORDER BY zoom_level,tile_column,tile_row;')
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def exportTree(archive, tree, qVerbose=False):
+    # Write every tile of a TileArchive into a TileTree
+    count = 0
+    for (zoom, column, row, png) in archive.tiles():
+        tree.write(zoom, column, row, png)
+        count += 1
+        if qVerbose and count % 10000 == 0:
+            print(count)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export an MBTiles archive of quilted tiles as a directory tree')
+    parser.add_argument('mbtiles', help='Archive written by mbtilesQuilt.py --mbtiles')
+    parser.add_argument('outdir', help='where to write the tree to')
+    parser.add_argument('--flip_y', default=True,
+                        help='Flip Y axis for non-TMS servers')
+    parser.add_argument('--store',
+                        help='Keep each distinct image once in this directory, the tiles are hard links to it')
+    parser.add_argument('--verbose', action='store_true', help='Output diagnositcs')
+    args = parser.parse_args()
+
+    archive = TileArchive(args.mbtiles)
+    count = exportTree(archive, TileTree(args.outdir, args.flip_y, args.store), args.verbose)
+    archive.close()
+    print('Exported', count, 'tiles to', args.outdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#! /usr/bin/env python3
+#
+# Build the low zoom overview tiles of a quilt from its tiles at a deeper zoom
+#
+# Each parent tile is the 2x2 mosaic of its children downsampled to one
+# tile. Subtrees are walked depth first, a parent is made as soon as its
+# four children are, so at most four tiles per zoom level are held at once.
+# Tiles the quilt already has at a lower zoom are kept, and used in place of
+# their children for the levels above, unless --replace.
+#
+# The tree is built a subtree at a time, each rooted at most subtreeDepth
+# zooms above the tiles it is built from, and only the keys in a subtree are
+# read, so memory is bounded however deep the quilt is. The subtrees below
+# the split zoom are shared out to worker processes, then the levels above it
+# are built the same way from the split zoom tiles they wrote.
+#
+# ./tileOverview.py --outdir RNC_ROOT --minZoom 3
+#
+
+import argparse
+import io
+import multiprocessing
+import numpy as np
+from PIL import Image
+
+import mbtilesQuilt
+import pngEncode
+
+subtreeDepth = 6 # So a subtree holds the keys of at most 4**6 tiles at its deepest zoom
+
+resamplers = {'box': Image.BOX, 'bilinear': Image.BILINEAR,
+              'lanczos': Image.LANCZOS, 'nearest': Image.NEAREST}
+
+
+def decodeTile(png):
+    # (RGBA image, metadata text or None) of an existing tile
+    image = Image.open(io.BytesIO(png))
+    metadata = image.info.get('meta')
+    return (image.convert('RGBA'), metadata)
+
+
+def downsample(children, resample):
+    # children is [(dx, dy, image)], TMS offsets so dy=1 is the northern half
+    # returns the parent image, or None if nothing is left of the children
+    (width, height) = children[0][2].size
+    mosaic = Image.new('RGBA', (2 * width, 2 * height), (0, 0, 0, 0))
+    for (dx, dy, image) in children:
+        mosaic.paste(image, (dx * width, (1 - dy) * height))
+    parent = mosaic.resize((width, height), resample)
+    # Quilted tiles are either transparent or opaque, keep them that way
+    alpha = np.asarray(parent.getchannel('A')) >= 128
+    if not alpha.any():
+        return None
+    parent.putalpha(Image.fromarray(alpha.view(np.uint8) * 255))
+    return parent
+
+
+def ancestorKeys(existing, fromZoom, toZoom):
+    # existing is {zoom: set of (column, row)}, for each zoom in
+    # [toZoom, fromZoom] the tiles that exist or have a descendant that does
+    nodes = {fromZoom: set(existing.get(fromZoom, ()))}
+    for zoom in range(fromZoom - 1, toZoom - 1, -1):
+        nodes[zoom] = set(existing.get(zoom, ())) | {(c >> 1, r >> 1) for (c, r) in nodes[zoom + 1]}
+    return nodes
+
+
+class Pyramid(object):
+    # Builds overviews for tiles at zooms below sourceZoom, writing into output
+
+    def __init__(self, output, existing, sourceZoom, replace=False, resample=Image.BOX):
+        self.output = output
+        self.existing = existing
+        self.sourceZoom = sourceZoom
+        self.replace = replace
+        self.resample = resample
+        self.count = 0
+
+    def build(self, nodes, zoom, column, row):
+        # (image, metadata) of a tile, building it from its children if need be
+        # returns (None, None) where there is nothing
+        if (column, row) in self.existing.get(zoom, ()) and (zoom == self.sourceZoom or not self.replace):
+            png = self.output.read(zoom, column, row)
+            if png is not None:
+                return decodeTile(png)
+        if zoom >= self.sourceZoom:
+            return (None, None)
+        children = []
+        metadatas = set()
+        for (dx, dy) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            child = (2 * column + dx, 2 * row + dy)
+            if child in nodes[zoom + 1]:
+                (image, metadata) = self.build(nodes, zoom + 1, *child)
+                if image is not None:
+                    children.append((dx, dy, image))
+                    metadatas.add(metadata)
+        if not children:
+            return (None, None)
+        parent = downsample(children, self.resample)
+        if parent is None:
+            return (None, None)
+        metadata = metadatas.pop() if len(metadatas) == 1 else None # only if the children agree
+        png = mbtilesQuilt.encodeTile(parent, metadata)
+        self.output.write(zoom, column, row, png)
+        self.count += 1
+        # Levels above see the tile as written, quantized, whichever worker built it
+        return decodeTile(png)
+
+
+def subtreeKeys(output, rootZoom, sourceZoom, root):
+    # {zoom: set of (column, row)} of the tiles under root, at rootZoom, down to sourceZoom
+    (column, row) = root
+    existing = {}
+    for zoom in range(rootZoom, sourceZoom + 1):
+        shift = zoom - rootZoom
+        existing[zoom] = set(output.keys(zoom, (column << shift, (column + 1) << shift),
+                                         (row << shift, (row + 1) << shift)))
+    return existing
+
+
+def rootKeys(output, rootZoom, sourceZoom):
+    # (column, row) at rootZoom of the tiles there or with a descendant down to sourceZoom
+    # The keys are streamed, only the roots are held.
+    roots = set()
+    for zoom in range(rootZoom, sourceZoom + 1):
+        shift = zoom - rootZoom
+        roots.update((column >> shift, row >> shift) for (column, row) in output.keys(zoom))
+    return roots
+
+
+def buildSubtrees(args, rootZoom, sourceZoom, roots):
+    # Build the overviews of the subtrees under roots, at rootZoom, one at a time
+    # returns the number of tiles written
+    mbtilesQuilt.setEncoder(args.palette, args.compressLevel, args.optimize)
+    output = mbtilesQuilt.openOutput(args)
+    count = 0
+    try:
+        for root in sorted(roots):
+            existing = subtreeKeys(output, rootZoom, sourceZoom, root)
+            pyramid = Pyramid(output, existing, sourceZoom, args.replace, resamplers[args.resample])
+            pyramid.build(ancestorKeys(existing, sourceZoom, rootZoom), rootZoom, *root)
+            count += pyramid.count
+    finally:
+        output.close()
+    return count
+
+
+def buildOverviews(args, minZoom, sourceZoom=None, nWorkers=1):
+    # Build every missing tile from sourceZoom - 1 up to minZoom
+    # sourceZoom defaults to the deepest zoom in the output
+    # returns the number of tiles written
+    output = mbtilesQuilt.openOutput(args)
+    try:
+        zooms = output.zooms()
+        if sourceZoom is None:
+            if not zooms:
+                return 0
+            sourceZoom = zooms[-1]
+        if minZoom >= sourceZoom:
+            return 0
+        splitZoom = max(minZoom, sourceZoom - subtreeDepth)
+        roots = rootKeys(output, splitZoom, sourceZoom)
+        # Deep enough that there are several subtrees per worker
+        while nWorkers > 1 and splitZoom < sourceZoom - 1 and len(roots) < 4 * nWorkers:
+            splitZoom += 1
+            roots = rootKeys(output, splitZoom, sourceZoom)
+        if not args.replace: # Nothing is built under a tile the quilt has, as walking down from minZoom
+            above = {zoom: set(output.keys(zoom)) for zoom in range(minZoom, splitZoom)}
+            roots = [(column, row) for (column, row) in roots
+                     if not any((column >> (splitZoom - zoom), row >> (splitZoom - zoom)) in keys
+                                for (zoom, keys) in above.items())]
+    finally:
+        output.close()
+
+    roots = sorted(roots)
+    if nWorkers > 1:
+        size = max(1, -(-len(roots) // (4 * nWorkers))) # Neighbouring subtrees together
+        jobs = [(args, splitZoom, sourceZoom, roots[i:i + size]) for i in range(0, len(roots), size)]
+        with multiprocessing.Pool(nWorkers) as pool:
+            count = sum(pool.starmap(buildSubtrees, jobs))
+    else:
+        count = buildSubtrees(args, splitZoom, sourceZoom, roots)
+    if splitZoom == minZoom:
+        return count
+    # The levels above the split, from what was built at splitZoom
+    return count + buildOverviews(args, minZoom, splitZoom, nWorkers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build overview tiles from the deepest zoom of a quilt')
+    parser.add_argument('--outdir', default='RNC_ROOT', help='Tree written by mbtilesQuilt.py')
+    parser.add_argument('--mbtiles', help='Archive written by mbtilesQuilt.py --mbtiles, instead of outdir')
+    parser.add_argument('--store', help='Content store the tree\'s tiles link to, as given to mbtilesQuilt.py')
+    parser.add_argument('--flip_y', default=True, help='Flip Y axis for non-TMS servers')
+    parser.add_argument('--minZoom', type=int, default=0, help='Shallowest zoom to build')
+    parser.add_argument('--maxZoom', type=int,
+                        help='Zoom to build from, default the deepest in the quilt')
+    parser.add_argument('--replace', action='store_true',
+                        help='Rebuild tiles the quilt already has below maxZoom')
+    parser.add_argument('--resample', default='box', choices=sorted(resamplers),
+                        help='Filter used to halve the mosaic of children')
+    parser.add_argument('--palette',
+                        help='JSON palette from pngEncode.py, default adapt a palette to each tile')
+    parser.add_argument('--compressLevel', type=int, default=6, choices=range(10),
+                        help='zlib level for the overview tiles')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Search for the smallest encoding of each tile, slower')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    args = parser.parse_args()
+
+    if args.palette is not None:
+        args.palette = pngEncode.loadPalette(args.palette)
+    count = buildOverviews(args, args.minZoom, args.maxZoom, max(1, args.workers))
+    print('Wrote', count, 'overview tiles')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+#
+# Serve quilted tiles straight from the MBTiles panels, composited on demand
+#
+# Each request looks up the tile in every panel, composites and masks it as
+# mbtilesQuilt.py would, and keeps recently served tiles in a bounded LRU
+# cache. Requests run on a fixed pool of threads, each with its own read-only
+# TileSource for each panel.
+#
+# URLs, with rows the way mbtilesQuilt.py would write them:
+#   /{z}/{x}/{y}.png      XYZ, origin top left
+#   /tms/{z}/{x}/{y}.png  TMS, origin bottom left
+#   /Z{z}/{row}/{x}.png   the RNC_ROOT tree layout, flipped per --flip_y
+#
+
+import argparse
+import collections
+import os
+import os.path
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import coverageIndex
+import mbtilesQuilt
+import panels
+import tileClassifier
+import tileSource
+
+
+class TileCache(object):
+    # LRU cache of rendered tiles, bounded by total bytes
+    # b'' is cached for tiles with no data
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.nBytes = 0
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            png = self.tiles.get(key)
+            if png is None:
+                self.misses += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return png
+
+    def put(self, key, png):
+        with self.lock:
+            if key in self.tiles:
+                return
+            self.tiles[key] = png
+            self.nBytes += len(png) + 64 # count the key too, so empties are not free
+            while self.nBytes > self.maxBytes and self.tiles:
+                (k, old) = self.tiles.popitem(last=False)
+                self.nBytes -= len(old) + 64
+
+
+class TileRenderer(object):
+    # Composites tiles from the panels, one set of TileSources per thread
+
+    def __init__(self, args, fns):
+        self.args = args
+        self.fns = fns
+        self.local = threading.local()
+        self.classifier = tileClassifier.TileClassifier(args.uniformCache)
+        self.cache = TileCache(args.cacheMB * 1024 * 1024)
+        self.coverage = coverageIndex.openIfFresh(args.coverage, fns)
+        if self.coverage is not None: # Loaded now, lookups are then in memory from any thread
+            self.coverage.load()
+            self.coverage.close()
+            self.panelIndex = {coverageIndex.panelName(fn): index for (index, fn) in enumerate(fns)}
+
+    def sources(self):
+        if not hasattr(self.local, 'sources'):
+            withMeta = self.args.metadataUnits == "oldFormatMBTiles"
+            self.local.sources = [tileSource.TileSource(fn, withMeta) for fn in self.fns]
+        return self.local.sources
+
+    def tile(self, zoom, column, row):
+        # png bytes of the tile at TMS (zoom, column, row), or None
+        key = (zoom, column, row)
+        png = self.cache.get(key)
+        if png is None:
+            indices = None
+            if self.coverage is not None: # Only the panels with a tile there, in the order of fns
+                indices = sorted(self.panelIndex[panel] for panel in self.coverage.covering(*key)
+                                 if panel in self.panelIndex)
+            png = mbtilesQuilt.renderTile(self.args, key, self.sources(), self.classifier, indices)
+            png = png or b''
+            self.cache.put(key, png)
+        return png or None
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    xyz = re.compile(r'^/(tms/)?(\d+)/(\d+)/(\d+)\.png$')
+    tree = re.compile(r'^/Z(\d+)/(\d+)/(\d+)\.png$')
+
+    def do_GET(self):
+        renderer = self.server.renderer
+        key = self.parse(self.path.split('?')[0])
+        if key is None:
+            self.send_error(400, 'Expected /{z}/{x}/{y}.png, /tms/{z}/{x}/{y}.png or /Z{z}/{row}/{x}.png')
+            return
+        png = renderer.tile(*key)
+        if png is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(png)))
+        self.send_header('Cache-Control', 'max-age={}'.format(renderer.args.maxAge))
+        self.end_headers()
+        self.wfile.write(png)
+
+    def parse(self, path):
+        # TMS (zoom, column, row) of a request path, or None
+        match = self.xyz.match(path)
+        if match:
+            (tms, zoom, column, row) = (match.group(1), int(match.group(2)),
+                                        int(match.group(3)), int(match.group(4)))
+            flip = not tms
+        else:
+            match = self.tree.match(path)
+            if not match:
+                return None
+            (zoom, row, column) = (int(match.group(1)), int(match.group(2)), int(match.group(3)))
+            flip = self.server.renderer.args.flip_y
+        if zoom > 30 or column >= 2 ** zoom or row >= 2 ** zoom:
+            return None
+        if flip:
+            row = (2 ** zoom) - (1 + row)
+        return (zoom, column, row)
+
+    def log_message(self, format, *args):
+        if self.server.renderer.args.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class TileHTTPServer(HTTPServer):
+    # Requests are handled on a fixed pool of threads, so each thread's
+    # panel connections are opened once and reused
+
+    def __init__(self, address, handler, nThreads):
+        HTTPServer.__init__(self, address, handler)
+        self.executor = ThreadPoolExecutor(max_workers=nThreads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.processRequestThread, request, client_address)
+
+    def processRequestThread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve quilted RNC tiles from the MBTiles panels')
+    parser.add_argument('panels', nargs='*', help='Panels to serve, bottom first, default all in indir')
+    parser.add_argument('--indir', default='MBTILES', help='where the ncds_*.mbtiles files are')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--metadataUnits', default="feet",
+                        choices=["feet", "metric", "oldFormatMBTiles"],
+                        help='Add metadata depth units')
+    parser.add_argument('--flip_y', default=True,
+                        help='Flip Y axis of /Z{z}/{row}/{x}.png requests, as the tree is written')
+    parser.add_argument('--colors', nargs='+', type=mbtilesQuilt.parseColor,
+                        default=[[0xF4, 0xE8, 0xC1], [0xEF, 0xD8, 0xA3]],
+                        help='Background colors, as RRGGBB, to make transparent')
+    parser.add_argument('--uniformCache',
+                        help='SQLite file of tiles known to be one color, default indir/uniformTiles.db unless indir is read only')
+    parser.add_argument('--palette',
+                        help='JSON palette from pngEncode.py, default adapt a palette to each tile')
+    parser.add_argument('--compressLevel', type=int, default=6, choices=range(10),
+                        help='zlib level for the served tiles, 1 fastest to 9 smallest')
+    parser.add_argument('--coverage',
+                        help='Panel coverage index from coverageIndex.py, default indir/coverage.db, used if up to date')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 4,
+                        help='Number of request threads, each with its own panel connections')
+    parser.add_argument('--cacheMB', type=int, default=256, help='Size of the rendered tile cache')
+    parser.add_argument('--maxAge', type=int, default=3600, help='Cache-Control max-age for clients')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+    args.merge = True
+
+    fns = [panels.panelFilename(args.indir, panel)
+           for panel in panels.resolvePanels(args.panels, args.indir)]
+    if not fns:
+        parser.error('No panels found in {}'.format(args.indir))
+    if args.uniformCache is None:
+        args.uniformCache = tileClassifier.defaultCache(args.indir)
+    if args.coverage is None:
+        args.coverage = os.path.join(args.indir, 'coverage.db')
+    mbtilesQuilt.setTransparentColors(args.colors)
+    import pngEncode
+    mbtilesQuilt.setEncoder(pngEncode.loadPalette(args.palette) if args.palette else None,
+                            args.compressLevel)
+
+    server = TileHTTPServer((args.host, args.port), TileHandler, max(1, args.threads))
+    server.renderer = TileRenderer(args, fns)
+    print('Serving', len(fns), 'panels on http://{}:{}/'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.renderer.classifier.save()
+        cache = server.renderer.cache
+        print('Cache hits', cache.hits, 'misses', cache.misses)
+
+
+if __name__ == "__main__":
+    main()
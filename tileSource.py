@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+#
+# Read the tiles of one MBTiles panel
+#
+# Tiles are streamed in zoom/column/row order, the order of the tiles index,
+# a batch of rows at a time, so memory stays bounded however large the
+# panel is. In oldFormatMBTiles panels each tile's metadata is in the map
+# table, it is joined in the same query rather than looked up tile by tile.
+#
+# Blobs are handed out as memoryviews, so the PNG header checks, hashing and
+# decoding all work on the bytes sqlite3 returned without copying them.
+#
+
+import itertools
+import sqlite3
+
+
+class TileSource(object):
+    # One panel, opened read only
+    # rows are (zoom, column, row, blob, meta), meta is None unless withMeta
+
+    def __init__(self, fn, withMeta=False, batchSize=64):
+        self.fn = fn
+        self.batchSize = batchSize
+        self.conn = sqlite3.connect('file:{}?mode=ro'.format(fn), uri=True,
+                                    check_same_thread=False) # quiltPipeline.py reads in a thread
+        self.withMeta = withMeta and self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name='map';").fetchone() is not None
+        if self.withMeta:
+            self.columns = ('zoom_level,tile_column,tile_row,tile_data,'
+                            '(SELECT grid_id FROM map WHERE map.zoom_level=tiles.zoom_level'
+                            ' AND map.tile_column=tiles.tile_column'
+                            ' AND map.tile_row=tiles.tile_row)')
+        else:
+            self.columns = 'zoom_level,tile_column,tile_row,tile_data,NULL'
+
+    def stream(self, sql, params):
+        # yields rows of a query, fetched batchSize at a time
+        cursor = self.conn.execute(sql, params)
+        try:
+            while True:
+                batch = cursor.fetchmany(self.batchSize)
+                if not batch:
+                    return
+                for (zoom, column, row, blob, meta) in batch:
+                    yield (zoom, column, row, memoryview(blob), meta)
+        finally:
+            cursor.close()
+
+    def tiles(self, nWorkers=1, worker=0, region=None, after=None):
+        # Walk the rows of the panel in index order
+        # Only rows % nWorkers == worker are read.
+        # With a region, each zoom level is a range query on the box around the
+        # region's tiles, and only the candidates are tested against the region.
+        # after, a (zoom, column, row), skips the rows up to and including it.
+        shard = (' AND tile_row % ? = ?', (nWorkers, worker)) if nWorkers > 1 else ('', ())
+        if after is not None: # spelled out, row values need SQLite 3.15
+            (zoom, column, row) = after
+            shard = (shard[0] + ' AND (zoom_level>? OR (zoom_level=? AND'
+                     ' (tile_column>? OR (tile_column=? AND tile_row>?))))',
+                     shard[1] + (zoom, zoom, column, column, row))
+        if region is None:
+            return self.stream('SELECT ' + self.columns + ' FROM tiles'
+                               ' WHERE 1' + shard[0] +
+                               ' ORDER BY zoom_level,tile_column,tile_row;', shard[1])
+        (minZoom, maxZoom) = self.conn.execute(
+                'SELECT MIN(zoom_level),MAX(zoom_level) FROM tiles;').fetchone()
+        if minZoom is None:
+            return iter(())
+        return itertools.chain.from_iterable(
+                self.regionTiles(zoom, shard, region) for zoom in range(minZoom, maxZoom + 1))
+
+    def regionTiles(self, zoom, shard, region):
+        bounds = region.bounds(zoom)
+        if bounds is None:
+            return
+        (txMin, txMax, tyMin, tyMax) = bounds
+        rows = self.stream('SELECT ' + self.columns + ' FROM tiles'
+                           ' WHERE zoom_level=? AND tile_column BETWEEN ? AND ?'
+                           ' AND tile_row BETWEEN ? AND ?' + shard[0] +
+                           ' ORDER BY zoom_level,tile_column,tile_row;',
+                           (zoom, txMin, txMax, tyMin, tyMax) + shard[1])
+        for item in rows:
+            if region.contains(zoom, item[1], item[2]):
+                yield item
+
+    def tile(self, zoom, column, row):
+        # (blob, meta) of one tile, or None
+        result = self.conn.execute('SELECT ' + self.columns + ' FROM tiles'
+                                   ' WHERE zoom_level=? AND tile_column=? AND tile_row=?;',
+                                   (zoom, column, row)).fetchone()
+        return (memoryview(result[3]), result[4]) if result else None
+
+    def close(self):
+        self.conn.close()
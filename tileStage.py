@@ -0,0 +1,211 @@
+#! /usr/bin/env python3
+#
+# Quilt into a staging version of the tile tree and publish it with one rename
+#
+# With mbtilesQuilt.py --stage, outdir (RNC_ROOT) is a symlink to a version
+# in outdir.versions. A quilt writes into a new version. A full quilt starts
+# it empty, so tiles no longer in the panels are gone from it, and a quilt of
+# only some tiles starts it as a hard linked copy of the published one, so
+# merging sees the tiles already there.
+# Tiles are only ever replaced by renaming a new file over them, never
+# written in place, so the published version does not change under clients.
+# When the quilt finishes the symlink is replaced in one rename.
+#
+# Each worker checkpoints the last tile it finished. A version being staged
+# has a checkpoint file beside it, and a killed quilt run again with the same
+# options resumes that version from the checkpoints.
+#
+# ./tileStage.py RNC_ROOT                      list the versions
+# ./tileStage.py RNC_ROOT --publish VERSION    roll back, or forward, to a version
+#
+
+import argparse
+import os
+import os.path
+import shutil
+import sqlite3
+import time
+
+
+def versionsDir(outdir):
+    return os.path.normpath(outdir) + '.versions'
+
+
+def versionPath(outdir, version):
+    return os.path.join(versionsDir(outdir), version)
+
+
+def checkpointFilename(outdir, version):
+    return os.path.join(versionsDir(outdir), version + '.checkpoint.db')
+
+
+def publishedVersion(outdir):
+    # The version outdir links to, or None
+    if not os.path.islink(outdir):
+        return None
+    return os.path.basename(os.path.normpath(os.readlink(outdir)))
+
+
+def versions(outdir):
+    # {version: True if it is still being staged}, of the versions in outdir.versions
+    vdir = versionsDir(outdir)
+    if not os.path.isdir(vdir):
+        return {}
+    return {name: os.path.exists(checkpointFilename(outdir, name)) for name in os.listdir(vdir)
+            if os.path.isdir(os.path.join(vdir, name)) and not name.endswith('.cloning')}
+
+
+class Checkpoint(object):
+    # The options a version is staged with, the last tile each worker finished,
+    # and the mbtilesQuilt.py --manifest run staging it, carried on when resuming
+
+    def __init__(self, fn):
+        self.conn = sqlite3.connect(fn, timeout=600)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS settings (settings TEXT);')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS manifest (run INTEGER);')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS workers'
+                              ' (worker INTEGER PRIMARY KEY, zoom_level INTEGER,'
+                              ' tile_column INTEGER, tile_row INTEGER, count INTEGER, saved REAL);')
+
+    def settings(self):
+        result = self.conn.execute('SELECT settings FROM settings;').fetchone()
+        return result[0] if result else None
+
+    def setSettings(self, settings):
+        with self.conn:
+            self.conn.execute('DELETE FROM settings;')
+            self.conn.execute('INSERT INTO settings VALUES (?);', (settings,))
+
+    def manifestRun(self):
+        result = self.conn.execute('SELECT run FROM manifest;').fetchone()
+        return result[0] if result else None
+
+    def setManifestRun(self, run):
+        with self.conn:
+            self.conn.execute('DELETE FROM manifest;')
+            self.conn.execute('INSERT INTO manifest VALUES (?);', (run,))
+
+    def get(self, worker):
+        # ((zoom, column, row), count) of the last tile the worker finished, or (None, 0)
+        result = self.conn.execute('SELECT zoom_level, tile_column, tile_row, count FROM workers'
+                                   ' WHERE worker=?;', (worker,)).fetchone()
+        if result is None:
+            return (None, 0)
+        return (tuple(result[:3]), result[3])
+
+    def save(self, worker, key, count):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO workers VALUES (?,?,?,?,?,?);',
+                              (worker,) + tuple(key) + (count, time.time()))
+
+    def close(self):
+        self.conn.close()
+
+
+def cloneTree(src, dst):
+    # Hard link every tile of src into dst, copying where links are not possible
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        odir = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(odir, exist_ok=True)
+        for name in filenames:
+            if name.endswith('.tmp'): # left by a killed write
+                continue
+            try:
+                os.link(os.path.join(dirpath, name), os.path.join(odir, name))
+            except OSError:
+                shutil.copy2(os.path.join(dirpath, name), os.path.join(odir, name))
+
+
+def stageVersion(outdir, settings, clone=False, qVerbose=False):
+    # The version to quilt into, resuming one staged with the same settings
+    # A new version is a copy of the published tree if clone, else empty.
+    # returns (version, path, checkpoint filename, True if resumed)
+    vdir = versionsDir(outdir)
+    os.makedirs(vdir, exist_ok=True)
+    for name in os.listdir(vdir):
+        if name.endswith('.cloning'): # interrupted before it was staged
+            shutil.rmtree(os.path.join(vdir, name))
+    for (version, staging) in sorted(versions(outdir).items()):
+        if not staging:
+            continue
+        checkpoint = Checkpoint(checkpointFilename(outdir, version))
+        matches = checkpoint.settings() == settings
+        checkpoint.close()
+        if matches:
+            if qVerbose:
+                print('Resuming staged version', version)
+            return (version, versionPath(outdir, version), checkpointFilename(outdir, version), True)
+        if qVerbose:
+            print('Discarding staged version', version, 'quilted with other options')
+        discard(outdir, version)
+
+    version = time.strftime('%Y%m%dT%H%M%S')
+    path = versionPath(outdir, version)
+    if clone and os.path.isdir(outdir): # the published tree, a version or a plain directory
+        cloning = path + '.cloning'
+        cloneTree(os.path.realpath(outdir), cloning)
+        os.rename(cloning, path)
+    else:
+        os.makedirs(path)
+    checkpoint = Checkpoint(checkpointFilename(outdir, version))
+    checkpoint.setSettings(settings)
+    checkpoint.close()
+    if qVerbose:
+        print('Staging version', version, 'in', path)
+    return (version, path, checkpointFilename(outdir, version), False)
+
+
+def publish(outdir, version):
+    # Point outdir at version in one rename
+    # A plain directory at outdir, from before staging, is moved into the versions first
+    outdir = os.path.normpath(outdir)
+    target = os.path.join(os.path.basename(versionsDir(outdir)), version) # relative, so the tree can move
+    if not os.path.isdir(os.path.join(os.path.dirname(outdir), target)):
+        raise ValueError('No version {} of {}'.format(version, outdir))
+    if os.path.isdir(outdir) and not os.path.islink(outdir):
+        os.rename(outdir, versionPath(outdir, time.strftime('%Y%m%dT%H%M%S', time.localtime(
+                  os.path.getmtime(outdir))) + '.unstaged'))
+    tmp = '{}.{}.link'.format(outdir, os.getpid())
+    os.symlink(target, tmp)
+    os.replace(tmp, outdir)
+    if os.path.exists(checkpointFilename(outdir, version)):
+        os.remove(checkpointFilename(outdir, version))
+
+
+def discard(outdir, version):
+    shutil.rmtree(versionPath(outdir, version), ignore_errors=True)
+    if os.path.exists(checkpointFilename(outdir, version)):
+        os.remove(checkpointFilename(outdir, version))
+
+
+def prune(outdir, keep):
+    # Remove all but the newest keep finished versions, never the published one
+    # returns the versions removed
+    published = publishedVersion(outdir)
+    finished = sorted(version for (version, staging) in versions(outdir).items() if not staging)
+    removed = [version for version in finished[:max(0, len(finished) - keep)] if version != published]
+    for version in removed:
+        discard(outdir, version)
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List, or publish, the staged versions of a tile tree')
+    parser.add_argument('outdir', help='Symlink written by mbtilesQuilt.py --stage')
+    parser.add_argument('--publish', metavar='VERSION', help='Point outdir at this version')
+    parser.add_argument('--prune', type=int, metavar='N', help='Keep only the newest N finished versions')
+    args = parser.parse_args()
+
+    if args.publish:
+        publish(args.outdir, args.publish)
+    if args.prune is not None:
+        for version in prune(args.outdir, args.prune):
+            print('Removed', version)
+    published = publishedVersion(args.outdir)
+    for (version, staging) in sorted(versions(args.outdir).items()):
+        print(version, 'published' if version == published else 'staging' if staging else '')
+
+
+if __name__ == "__main__":
+    main()